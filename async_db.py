@@ -0,0 +1,38 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDB:
+    """Async facade over a synchronous database object.
+
+    Every method of the wrapped object becomes a coroutine executed on a
+    dedicated DB thread, so SQLite I/O never runs on the event loop. At most
+    `max_pending` calls may be queued; further callers wait for a free slot.
+    """
+
+    def __init__(self, target, workers=1, max_pending=1000, name="db"):
+        self.sync = target
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._slots = asyncio.Semaphore(max_pending)
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._executor, functools.partial(method, *args, **kwargs)
+                )
+
+        self.__dict__[name] = call
+        return call
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.sync.close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,115 @@
+"""Benchmark: settings-menu callbacks/sec, if/elif chain vs callback router.
+
+Imports the bot module against a throwaway database and replays the
+callback_data a user produces while walking through the settings menus.
+The legacy handler is the former if/elif chain that rebuilt every
+keyboard on each press; the new one is `gbot.process_callback`. Telegram
+calls are replaced by no-op coroutines, so only dispatch, keyboard
+construction and settings writes are measured.
+
+    python -m benchmarks.callbacks --rounds 200 --users 10
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SESSION = [
+    "age", "age_13_18", "age_19_35", "back_to_settings",
+    "style", "style_long", "style_short", "back_to_settings",
+    "advice", "advice_yes", "advice_no", "back_to_settings",
+    "bot_gender", "bot_gender_female", "bot_gender_neutral", "back_to_settings",
+    "user_gender", "user_gender_male", "user_gender_neutral", "back_to_settings",
+]
+
+
+async def edit_text(text, reply_markup=None):
+    pass
+
+
+def fake_callback(user_id, data):
+    return SimpleNamespace(
+        data=data,
+        from_user=SimpleNamespace(id=user_id),
+        message=SimpleNamespace(edit_text=edit_text)
+    )
+
+
+def legacy_handler(gbot):
+    build = gbot.get_setting_keyboard.__wrapped__
+    settings_keyboard = gbot.get_settings_keyboard.__wrapped__
+
+    async def process_callback(callback_query):
+        user_id = callback_query.from_user.id
+        settings = await gbot.settings_store.get(user_id)
+        data = callback_query.data
+        if data == "age":
+            await callback_query.message.edit_text("Выберите ваш возраст:", reply_markup=build("age", settings.age))
+        elif data.startswith("age_"):
+            age_range = data.split("_")[1:]
+            await gbot.settings_store.update(user_id, age=f"{age_range[0]}-{age_range[1]}")
+            await callback_query.message.edit_text("Выберите ваш возраст:", reply_markup=build("age", settings.age))
+        elif data == "style":
+            await callback_query.message.edit_text("Выберите стиль ответов:", reply_markup=build("style", settings.style))
+        elif data.startswith("style_"):
+            await gbot.settings_store.update(user_id, style=data.split("_")[1])
+            await callback_query.message.edit_text("Выберите стиль ответов:", reply_markup=build("style", settings.style))
+        elif data == "advice":
+            await callback_query.message.edit_text("Хотите ли вы получать советы?", reply_markup=build("advice", settings.advice))
+        elif data.startswith("advice_"):
+            await gbot.settings_store.update(user_id, advice=data.split("_")[1] == "yes")
+            await callback_query.message.edit_text("Хотите ли вы получать советы?", reply_markup=build("advice", settings.advice))
+        elif data == "bot_gender":
+            await callback_query.message.edit_text("Выберите пол бота:", reply_markup=build("bot_gender", settings.bot_gender))
+        elif data.startswith("bot_gender_"):
+            await gbot.settings_store.update(user_id, bot_gender=data.split("_")[2])
+            await callback_query.message.edit_text("Выберите пол бота:", reply_markup=build("bot_gender", settings.bot_gender))
+        elif data == "user_gender":
+            await callback_query.message.edit_text("Укажите ваш пол:", reply_markup=build("user_gender", settings.user_gender))
+        elif data.startswith("user_gender_"):
+            await gbot.settings_store.update(user_id, user_gender=data.split("_")[2])
+            await callback_query.message.edit_text("Укажите ваш пол:", reply_markup=build("user_gender", settings.user_gender))
+        elif data == "back_to_settings":
+            await callback_query.message.edit_text("⚙️ Настройки", reply_markup=settings_keyboard())
+
+    return process_callback
+
+
+async def run(handler, rounds, users):
+    queries = [fake_callback(user_id, data) for user_id in range(users) for data in SESSION]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for query in queries:
+            await handler(query)
+    return rounds * len(queries) / (time.perf_counter() - start)
+
+
+async def main(args):
+    import gbot
+
+    for name, handler in [
+        ("legacy if/elif", legacy_handler(gbot)),
+        ("router", gbot.process_callback),
+    ]:
+        rate = await run(handler, args.rounds, args.users)
+        print(f"{name:15s} {rate:10.0f} callbacks/s")
+    await gbot.dp.emit_shutdown(bot=gbot.bot)
+    await gbot.bot.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--users", type=int, default=10)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+    os.environ.setdefault("ADMIN_IDS", "1")
+    asyncio.run(main(args))
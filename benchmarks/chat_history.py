@@ -0,0 +1,106 @@
+"""Benchmark: latest-N chat history lookups on a large synthetic messages table.
+
+Builds a `messages` table with --rows rows spread over --users users, then
+times the old query (ORDER BY timestamp, no index) against
+Database.get_chat_history with the (user_id, id) index, and with an extra
+covering index for comparison.
+
+    python -m benchmarks.chat_history --rows 10000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+
+LEGACY_QUERY = '''
+    SELECT message_text, is_bot, timestamp
+    FROM messages
+    WHERE user_id = ?
+    ORDER BY timestamp DESC
+    LIMIT ?
+'''
+
+COVERING_INDEX = '''
+    CREATE INDEX idx_messages_covering
+    ON messages (user_id, id, is_bot, timestamp, message_text)
+'''
+
+
+def fill(conn, rows, users):
+    conn.execute('DROP INDEX IF EXISTS idx_messages_user_id_id')
+    conn.execute('''
+        WITH RECURSIVE seq(x) AS (
+            SELECT 0 UNION ALL SELECT x + 1 FROM seq WHERE x < ? - 1
+        )
+        INSERT INTO users (user_id) SELECT x FROM seq
+    ''', (users,))
+    conn.execute('''
+        WITH RECURSIVE seq(x) AS (
+            SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < ?
+        )
+        INSERT INTO messages (user_id, message_text, is_bot, timestamp)
+        SELECT abs(random()) % ?,
+               'Синтетическое сообщение номер ' || x,
+               x % 2,
+               datetime(1700000000 + x, 'unixepoch')
+        FROM seq
+    ''', (rows, users))
+    conn.commit()
+
+
+def time_queries(run, user_ids):
+    start = time.perf_counter()
+    for user_id in user_ids:
+        run(user_id)
+    elapsed = time.perf_counter() - start
+    return elapsed / len(user_ids) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--limit", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--legacy-queries", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "chat_history.db"))
+        conn = db.conn.conn
+
+        start = time.perf_counter()
+        fill(conn, args.rows, args.users)
+        print(f"filled {args.rows} rows in {time.perf_counter() - start:.1f}s")
+
+        sample = [random.randrange(args.users) for _ in range(args.queries)]
+
+        legacy = time_queries(
+            lambda user_id: conn.execute(LEGACY_QUERY, (user_id, args.limit)).fetchall(),
+            sample[:args.legacy_queries]
+        )
+        print(f"no index, ORDER BY timestamp: {legacy:10.3f} ms/query")
+
+        start = time.perf_counter()
+        conn.execute('CREATE INDEX idx_messages_user_id_id ON messages (user_id, id)')
+        conn.commit()
+        print(f"built (user_id, id) index in {time.perf_counter() - start:.1f}s")
+        indexed = time_queries(lambda user_id: db.get_chat_history(user_id, args.limit), sample)
+        print(f"(user_id, id) index:          {indexed:10.3f} ms/query")
+
+        conn.execute(COVERING_INDEX)
+        conn.commit()
+        covering = time_queries(lambda user_id: db.get_chat_history(user_id, args.limit), sample)
+        print(f"covering index:               {covering:10.3f} ms/query")
+
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
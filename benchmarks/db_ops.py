@@ -0,0 +1,99 @@
+"""Micro-benchmark: connect-per-call SQLite vs the shared connection manager.
+
+Replays the queries of one chat turn (settings lookup, two add_message
+calls and a history read) and reports turns/sec and statements/sec.
+
+    python -m benchmarks.db_ops --turns 2000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+
+STATEMENTS_PER_TURN = 4
+
+
+class LegacyDatabase:
+    """The pre-connection-manager access pattern: one connection per call."""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        Database(db_file).close()
+
+    def add_user(self, user_id, username, first_name, last_name):
+        conn = sqlite3.connect(self.db_file)
+        conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+        conn.commit()
+
+    def add_message(self, user_id, message_text, is_bot):
+        conn = sqlite3.connect(self.db_file)
+        conn.execute('''
+            INSERT INTO messages (user_id, message_text, is_bot, timestamp)
+            VALUES (?, ?, ?, datetime('now'))
+        ''', (user_id, message_text, is_bot))
+        conn.commit()
+        conn.close()
+
+    def get_chat_history(self, user_id, limit=10):
+        conn = sqlite3.connect(self.db_file)
+        rows = conn.execute('''
+            SELECT message_text, is_bot, timestamp
+            FROM messages
+            WHERE user_id = ?
+            ORDER BY timestamp DESC
+            LIMIT ?
+        ''', (user_id, limit)).fetchall()
+        conn.close()
+        return rows[::-1]
+
+    def get_user_settings(self, user_id):
+        conn = sqlite3.connect(self.db_file)
+        row = conn.execute(
+            'SELECT bot_gender, user_gender FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        conn.close()
+        return row
+
+    def close(self):
+        pass
+
+
+def run_turns(database, turns, users):
+    start = time.perf_counter()
+    for i in range(turns):
+        user_id = i % users
+        database.get_user_settings(user_id)
+        database.add_message(user_id, "Как справиться с тревогой перед экзаменом?", False)
+        database.get_chat_history(user_id)
+        database.add_message(user_id, "Давай попробуем разобраться, что именно тревожит.", True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for name, factory in (("before", LegacyDatabase), ("after", Database)):
+            database = factory(os.path.join(tmp, f"{name}.db"))
+            for user_id in range(args.users):
+                database.add_user(user_id, None, None, None)
+            elapsed = run_turns(database, args.turns, args.users)
+            database.close()
+            results[name] = elapsed
+            print(f"{name:>6}: {args.turns / elapsed:10.1f} turns/s "
+                  f"{args.turns * STATEMENTS_PER_TURN / elapsed:10.1f} ops/s")
+        print(f"speedup: {results['before'] / results['after']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
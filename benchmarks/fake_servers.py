@@ -0,0 +1,124 @@
+"""Local stand-ins for the Telegram Bot API and OpenAI-compatible LLM endpoints.
+
+One aiohttp app serves `/bot<token>/<method>` like the Bot API and
+`/v1/completions` and `/v1/chat/completions` like a model server, both
+plain and streamed (SSE). Latency, generation speed and error injection
+are configurable; every call is counted in `stats`.
+"""
+import asyncio
+import json
+import random
+from collections import Counter
+
+from aiohttp import web
+
+REPLY_WORDS = (
+    "Я", "слышу", "тебя.", "Похоже,", "сегодня", "был", "непростой", "день.", "Расскажи,", "что",
+    "сейчас", "чувствуешь", "сильнее", "всего?", "Иногда", "помогает", "просто", "назвать", "это", "вслух.",
+)
+
+
+class FakeServers:
+    """Fake Bot API and LLM on one port.
+
+    Bot API calls sleep `telegram_latency` and fail with 429 (retry after
+    `retry_after` seconds) with probability `telegram_error_rate`. LLM
+    calls wait `llm_latency` before the first token, then produce
+    `reply_tokens` tokens at `token_rate` per second; with probability
+    `llm_error_rate` they answer 500 instead.
+    """
+
+    def __init__(self, host="127.0.0.1", port=18701, llm_latency=0.3, token_rate=50.0, reply_tokens=40,
+                 llm_error_rate=0.0, telegram_latency=0.02, telegram_error_rate=0.0, retry_after=1, seed=0):
+        self.host = host
+        self.port = port
+        self.llm_latency = llm_latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.llm_error_rate = llm_error_rate
+        self.telegram_latency = telegram_latency
+        self.telegram_error_rate = telegram_error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.stats = Counter()
+        self.message_id = 0
+        self.runner = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_post("/v1/completions", self.completions)
+        app.router.add_post("/v1/chat/completions", self.completions)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.stats[f"telegram.{method}"] += 1
+        if self.telegram_latency:
+            await asyncio.sleep(self.telegram_latency)
+        if self.random.random() < self.telegram_error_rate:
+            self.stats["telegram.429"] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        if method.lower() in ("sendmessage", "editmessagetext", "senddocument"):
+            self.message_id += 1
+            chat_id = int(data.get("chat_id") or 0)
+            result = {
+                "message_id": self.message_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "text": str(data.get("text", "")),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def _reply_tokens(self):
+        return [self.random.choice(REPLY_WORDS) + " " for _ in range(self.reply_tokens)]
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        chat = request.path.endswith("/chat/completions")
+        self.stats["llm.chat" if chat else "llm.completion"] += 1
+        await asyncio.sleep(self.llm_latency)
+        if self.random.random() < self.llm_error_rate:
+            self.stats["llm.errors"] += 1
+            return web.json_response({"error": {"message": "injected failure"}}, status=500)
+
+        tokens = self._reply_tokens()
+        self.stats["llm.tokens"] += len(tokens)
+        if not body.get("stream"):
+            await asyncio.sleep(len(tokens) / self.token_rate)
+            text = "".join(tokens).strip()
+            choice = {"index": 0, "message": {"role": "assistant", "content": text}} if chat else {"index": 0, "text": text}
+            return web.json_response({"choices": [choice]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for token in tokens:
+            await asyncio.sleep(1 / self.token_rate)
+            choice = {"index": 0, "delta": {"content": token}} if chat else {"index": 0, "text": token}
+            await response.write(f"data: {json.dumps({'choices': [choice]}, ensure_ascii=False)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
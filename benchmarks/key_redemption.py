@@ -0,0 +1,122 @@
+"""Stress test: concurrent activation-key redemption never double-spends a key.
+
+Creates `--keys` keys, then starts `--processes` processes, each with its
+own SubscriptionDB connection, that all try to redeem every key (in the
+same order, to maximise collisions) for their own users. Afterwards it
+checks that every key was redeemed exactly once, by the user recorded in
+activation_keys, and that exactly those users are premium. The same run
+with the former SELECT-then-UPDATE redemption is shown for comparison.
+Exits non-zero if the current implementation breaks an invariant.
+
+    python -m benchmarks.key_redemption --processes 8 --keys 500
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from subscription_db import SubscriptionDB
+
+
+def legacy_activate_premium(db: SubscriptionDB, user_id, key):
+    """The former flow: SELECT, UPDATE and the grant as separate steps."""
+    with db.conn.transaction() as conn:
+        result = conn.execute('SELECT is_used FROM activation_keys WHERE key = ?', (key,)).fetchone()
+        if not result or result[0]:
+            return False
+        conn.execute('''
+            UPDATE activation_keys SET is_used = TRUE, used_by_user_id = ? WHERE key = ?
+        ''', (user_id, key))
+    db.conn.execute('''
+        UPDATE subscriptions SET is_premium = TRUE, activation_key = ? WHERE user_id = ?
+    ''', (key, user_id))
+    return True
+
+
+def worker(db_file, index, keys, legacy, start_at, results):
+    # A private connection per process, as in the webhook workers.
+    db = SubscriptionDB(db_file, legacy_db_file=None)
+    user_base = (index + 1) * 1_000_000
+    while time.time() < start_at:
+        pass
+    won = []
+    for number, key in enumerate(keys):
+        user_id = user_base + number
+        while True:
+            try:
+                if legacy:
+                    redeemed = legacy_activate_premium(db, user_id, key)
+                else:
+                    redeemed = db.activate_premium(user_id, key)
+                break
+            except sqlite3.OperationalError:
+                continue
+        if redeemed:
+            won.append((key, user_id))
+    db.close()
+    results.put(won)
+
+
+def run(db_file, processes, key_count, legacy):
+    subscriptions = SubscriptionDB(db_file, legacy_db_file=None)
+    keys = [subscriptions.create_activation_key() for _ in range(key_count)]
+    for index in range(processes):
+        for number in range(key_count):
+            user_id = (index + 1) * 1_000_000 + number
+            subscriptions.add_user(user_id)
+    subscriptions.close()
+
+    results = multiprocessing.Queue()
+    start_at = time.time() + 1
+    workers = [
+        multiprocessing.Process(target=worker, args=(db_file, index, keys, legacy, start_at, results))
+        for index in range(processes)
+    ]
+    for process in workers:
+        process.start()
+    won = [item for _ in workers for item in results.get()]
+    for process in workers:
+        process.join()
+
+    check = SubscriptionDB(db_file, legacy_db_file=None)
+    conn = check.conn
+    winners = {}
+    for key, user_id in won:
+        winners.setdefault(key, []).append(user_id)
+    double_spent = sum(1 for users in winners.values() if len(users) > 1)
+    unredeemed = key_count - len(winners)
+    recorded = dict(conn.fetchall('SELECT key, used_by_user_id FROM activation_keys WHERE is_used'))
+    mismatched = sum(1 for key, users in winners.items() if recorded.get(key) != users[-1] or len(users) > 1)
+    premium = {row[0] for row in conn.fetchall('SELECT user_id FROM subscriptions WHERE is_premium')}
+    extra_premium = len(premium - {user_id for users in winners.values() for user_id in users})
+    check.close()
+    return len(won), double_spent, unredeemed, mismatched, extra_premium
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--keys", type=int, default=500)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, legacy in (("select-then-update", True), ("conditional update", False)):
+            redemptions, double_spent, unredeemed, mismatched, extra_premium = run(
+                os.path.join(tmp, f"{legacy}.db"), args.processes, args.keys, legacy
+            )
+            print(f"{name:>20}: {redemptions} redemptions of {args.keys} keys, "
+                  f"{double_spent} double-spent, {unredeemed} unredeemed, "
+                  f"{mismatched} mismatched owners, {extra_premium} premium without a key")
+            if not legacy:
+                failed = redemptions != args.keys or double_spent or unredeemed or mismatched or extra_premium
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Benchmark: unbatched vs micro-batched requests to a fake completions server.
+
+The fake server behaves like a single GPU: requests are served one at a
+time and a batch costs --base-ms plus --per-prompt-ms for every prompt.
+Reports throughput and latency percentiles for each batching window.
+
+    python -m benchmarks.llm_batching --clients 64 --requests 512
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+
+from llm_batcher import CompletionBatcher
+from llm_client import LLMBackend, LLMClient
+
+PORT = 18401
+
+
+async def start_fake_server(base_ms, per_prompt_ms):
+    gpu = asyncio.Lock()
+
+    async def completions(request):
+        body = await request.json()
+        prompts = body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+        async with gpu:
+            await asyncio.sleep((base_ms + per_prompt_ms * len(prompts)) / 1000)
+        return web.json_response({
+            "choices": [{"index": i, "text": f"ответ на {prompt}"} for i, prompt in enumerate(prompts)]
+        })
+
+    app = web.Application()
+    app.router.add_post("/v1/completions", completions)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    return runner
+
+
+async def run(client, window_ms, max_batch, clients, requests):
+    batcher = CompletionBatcher(client, "local", window_ms / 1000, max_batch) if window_ms else None
+    latencies = []
+    counter = iter(range(requests))
+
+    async def worker():
+        for n in counter:
+            payload = {"model": "fake", "prompt": f"prompt {n}", "max_tokens": 16}
+            start = time.perf_counter()
+            if batcher is not None:
+                await batcher.complete(payload)
+            else:
+                await client.post_json("local", payload)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "throughput": requests / elapsed,
+        "p50": statistics.median(latencies) * 1000,
+        "p95": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--base-ms", type=float, default=40)
+    parser.add_argument("--per-prompt-ms", type=float, default=5)
+    parser.add_argument("--windows-ms", type=int, nargs="+", default=[0, 5, 20, 50])
+    parser.add_argument("--max-batch", type=int, default=16)
+    args = parser.parse_args()
+
+    runner = await start_fake_server(args.base_ms, args.per_prompt_ms)
+    client = LLMClient([LLMBackend("local", f"http://127.0.0.1:{PORT}/v1/completions")])
+    await client.start()
+    try:
+        for window_ms in args.windows_ms:
+            result = await run(client, window_ms, args.max_batch, args.clients, args.requests)
+            label = "unbatched" if not window_ms else f"window {window_ms} ms"
+            print(f"{label:>15}: {result['throughput']:8.1f} req/s "
+                  f"p50 {result['p50']:8.1f} ms  p95 {result['p95']:8.1f} ms")
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,277 @@
+"""Load test: N simulated users talking to gbot's dispatcher over fake servers.
+
+Starts benchmarks.fake_servers, imports `gbot` in a throwaway directory
+with Telegram and both LLM backends pointed at the fakes, and feeds raw
+updates to its dispatcher. Each user follows a conversation script:
+/start, the free trial, sometimes a walk through the settings menus or
+help, then a few chat messages with think time between them. An update's
+latency is the time `feed_raw_update` takes, i.e. until its handler
+has finished sending. Reports updates/sec, p50/p95/p99 overall and per
+kind of update, the fakes' call counts and how much the database grew.
+
+`--json` saves the results and `--baseline` compares a run with saved
+ones. Bot settings can be overridden with `--env KEY=VALUE`; Telegram's
+global send limit is raised by default because the fake server has none.
+
+    python -m benchmarks.load_test --users 100 --messages 10 --think 0.5
+    python -m benchmarks.load_test --json before.json
+    python -m benchmarks.load_test --baseline before.json --env FLOOD_DEBOUNCE_MS=700
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_servers import FakeServers
+
+MESSAGES = (
+    "привет",
+    "мне сегодня грустно",
+    "не могу уснуть уже третью ночь подряд, мысли крутятся по кругу",
+    "на работе всё навалилось разом, и я не понимаю, за что хвататься",
+    "поссорился с другом из-за ерунды, теперь неловко написать первым",
+    "спасибо, стало немного легче",
+    "а как понять, что это просто усталость, а не что-то серьёзное?",
+    "иногда кажется, что никто меня не слышит",
+    "ок",
+    "расскажи, что можно сделать прямо сейчас, чтобы успокоиться",
+)
+SETTINGS_WALKS = (
+    ("age", "age_19_35", "back_to_settings"),
+    ("style", "style_long", "back_to_settings"),
+    ("advice", "advice_yes", "back_to_settings"),
+    ("bot_gender", "bot_gender_female", "user_gender", "user_gender_male", "back_to_settings"),
+)
+PERCENTILES = (0.5, 0.95, 0.99)
+
+
+class Users:
+    """Builds raw updates with increasing ids."""
+
+    def __init__(self):
+        self.update_id = 0
+
+    def _message(self, user_id, text):
+        self.update_id += 1
+        message = {
+            "message_id": self.update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return message
+
+    def message(self, user_id, text):
+        message = self._message(user_id, text)
+        return {"update_id": self.update_id, "message": message}
+
+    def callback(self, user_id, data):
+        message = self._message(user_id, "⚙️ Настройки")
+        message["from"] = {"id": 42, "is_bot": True, "first_name": "Bot"}
+        return {
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id), "chat_instance": "load", "data": data, "message": message,
+                "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+            },
+        }
+
+
+def script(rng, messages):
+    """[(kind, payload)] for one user."""
+    steps = [("command", "/start"), ("button", "🎁 Попробовать бесплатно")]
+    if rng.random() < 0.5:
+        steps.append(("button", "⚙️ Настройки"))
+        steps += [("callback", data) for data in rng.choice(SETTINGS_WALKS)]
+    if rng.random() < 0.1:
+        steps.append(("button", "❓ Помощь"))
+    count = max(1, round(rng.gauss(messages, messages / 3)))
+    steps += [("chat", rng.choice(MESSAGES)) for _ in range(count)]
+    return steps
+
+
+def quantile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def db_size(directory) -> int:
+    """Bytes in the directory's SQLite files, after moving their WAL contents in."""
+    total = 0
+    for name in os.listdir(directory):
+        if name.endswith(".db"):
+            path = os.path.join(directory, name)
+            conn = sqlite3.connect(path)
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.close()
+            total += os.path.getsize(path)
+    return total
+
+
+async def simulate(gbot, users, user_id, steps, think, rng, latencies, errors):
+    await asyncio.sleep(rng.uniform(0, think))
+    for kind, payload in steps:
+        update = users.callback(user_id, payload) if kind == "callback" else users.message(user_id, payload)
+        start = time.perf_counter()
+        try:
+            await gbot.dp.feed_raw_update(gbot.bot, update)
+        except Exception as e:
+            errors.append(f"{kind}: {e}")
+        latencies[kind].append(time.perf_counter() - start)
+        if kind == "chat" and think:
+            await asyncio.sleep(rng.expovariate(1 / think))
+
+
+async def run(args):
+    fake = FakeServers(
+        port=args.port,
+        llm_latency=args.llm_latency,
+        token_rate=args.token_rate,
+        reply_tokens=args.reply_tokens,
+        llm_error_rate=args.llm_error_rate,
+        telegram_latency=args.telegram_latency,
+        telegram_error_rate=args.telegram_error_rate,
+        seed=args.seed,
+    )
+    await fake.start()
+
+    workdir = tempfile.mkdtemp(prefix="gbot-load-")
+    os.chdir(workdir)
+    overrides = {
+        "BOT_TOKEN": "123456:load-test",
+        "ADMIN_IDS": "1",
+        "TELEGRAM_API_URL": fake.url,
+        "TELEGRAM_GLOBAL_RATE": "100000",
+        "LOG_LEVEL": "CRITICAL",
+        "LLM_BACKENDS": json.dumps([
+            {"name": "local", "kind": "completion", "model": "fake",
+             "url": f"{fake.url}/v1/completions", "timeout": 30},
+            {"name": "deepseek", "kind": "chat", "model": "fake",
+             "url": f"{fake.url}/v1/chat/completions", "timeout": 30},
+        ]),
+    }
+    overrides.update(item.split("=", 1) for item in args.env)
+    os.environ.update(overrides)
+
+    import gbot
+
+    await gbot.dp.emit_startup(bot=gbot.bot)
+    size_before = db_size(workdir)
+    users = Users()
+    latencies = defaultdict(list)
+    errors = []
+    master = random.Random(args.seed)
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        simulate(gbot, users, 10_000 + index, script(rng, args.messages), args.think, rng, latencies, errors)
+        for index, rng in enumerate(random.Random(master.random()) for _ in range(args.users))
+    ))
+    elapsed = time.perf_counter() - start
+    bot_errors = gbot.metrics.counter("errors_total")
+    fallbacks = gbot.metrics.counter("llm_fallbacks_total")
+    await gbot.dp.emit_shutdown(bot=gbot.bot)
+    await gbot.bot.session.close()
+    await fake.close()
+
+    conn = sqlite3.connect(os.path.join(workdir, "chat_history.db"))
+    stored = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    conn.close()
+    size_after = db_size(workdir)
+
+    every = sorted(latency for values in latencies.values() for latency in values)
+    result = {
+        "users": args.users,
+        "updates": len(every),
+        "seconds": elapsed,
+        "updates_per_sec": len(every) / elapsed,
+        "latency_ms": {f"p{int(q * 100)}": quantile(every, q) * 1000 for q in PERCENTILES},
+        "by_kind": {
+            kind: {
+                "count": len(values),
+                **{f"p{int(q * 100)}": quantile(sorted(values), q) * 1000 for q in PERCENTILES},
+            }
+            for kind, values in sorted(latencies.items())
+        },
+        "errors": len(errors),
+        "bot_errors": bot_errors,
+        "llm_fallbacks": fallbacks,
+        "fake_calls": dict(sorted(fake.stats.items())),
+        "db_bytes": size_after - size_before,
+        "stored_messages": stored,
+        "env": {key: value for key, value in overrides.items() if key != "LLM_BACKENDS"},
+    }
+    for error in errors[:5]:
+        print(f"error: {error}")
+    return result
+
+
+def report(result, baseline=None):
+    def delta(value, old, lower_is_better=True):
+        if not old:
+            return ""
+        change = (value - old) / old
+        better = change < 0 if lower_is_better else change > 0
+        return f"  ({change:+.1%} {'better' if better else 'worse'})" if abs(change) >= 0.005 else "  (same)"
+
+    base = baseline or {}
+    print(f"{result['users']} users, {result['updates']} updates in {result['seconds']:.1f} s, "
+          f"{result['errors']} dispatcher errors, {result['bot_errors']} replies failed, "
+          f"{result['llm_fallbacks']} LLM fallbacks")
+    print(f"throughput: {result['updates_per_sec']:.1f} updates/s"
+          + delta(result["updates_per_sec"], base.get("updates_per_sec"), lower_is_better=False))
+    for name, value in result["latency_ms"].items():
+        print(f"  {name}: {value:8.1f} ms" + delta(value, base.get("latency_ms", {}).get(name)))
+    for kind, stats in result["by_kind"].items():
+        old = base.get("by_kind", {}).get(kind, {})
+        print(f"  {kind:>8} x{stats['count']:<6} "
+              + "  ".join(f"{name} {stats[name]:7.1f} ms" for name in ("p50", "p95", "p99"))
+              + delta(stats["p95"], old.get("p95")))
+    per_message = result["db_bytes"] / result["stored_messages"] if result["stored_messages"] else 0
+    print(f"database: {result['db_bytes'] / 1024:+.0f} KiB for {result['stored_messages']} messages "
+          f"({per_message:.0f} B/message)" + delta(result["db_bytes"], base.get("db_bytes")))
+    print("fake servers: " + ", ".join(f"{name}={count}" for name, count in result["fake_calls"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=10, help="mean chat messages per user")
+    parser.add_argument("--think", type=float, default=0.5, help="mean seconds between a reply and the next message")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds to the first token")
+    parser.add_argument("--token-rate", type=float, default=50, help="generated tokens per second")
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="share of Bot API calls answered 429")
+    parser.add_argument("--port", type=int, default=18701)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="bot setting override")
+    parser.add_argument("--json", help="save results to this file")
+    parser.add_argument("--baseline", help="compare with results saved by --json")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    result = asyncio.run(run(args))
+    report(result, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark: time a log call costs its caller, stdout handler vs queue handler.
+
+Logs one INFO line per simulated turn, as handle_message did with the AI
+response, to a stream whose writes take `--write-us` microseconds (a
+terminal, a pipe to a slow collector). The former setup is basicConfig's
+StreamHandler at DEBUG level, which writes on the calling thread; the new
+one is log_setup.setup_logging, which only queues the record. Reports the
+caller-side p50/p99 per call; the writer thread's time is not counted.
+
+    python -m benchmarks.logging_overhead --calls 20000 --write-us 50
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log_setup import setup_logging
+
+
+class SlowStream:
+    def __init__(self, write_seconds):
+        self.write_seconds = write_seconds
+
+    def write(self, text):
+        end = time.perf_counter() + self.write_seconds
+        while time.perf_counter() < end:
+            pass
+
+    def flush(self):
+        pass
+
+
+def reset_root():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+
+def measure(calls):
+    logger = logging.getLogger("gbot")
+    response = "Я слышу тебя. Расскажи, что случилось сегодня? " * 4
+    timings = []
+    for number in range(calls):
+        start = time.perf_counter()
+        logger.info(f"Финальный ответ ИИ: {response}", extra={"user_id": number})
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--write-us", type=float, default=50)
+    args = parser.parse_args()
+    stream = SlowStream(args.write_us / 1e6)
+
+    reset_root()
+    logging.basicConfig(level=logging.DEBUG, stream=stream)
+    p50, p99 = measure(args.calls)
+    print(f"{'stdout handler':>15}: p50 {p50 * 1e6:7.1f} us, p99 {p99 * 1e6:7.1f} us per call")
+
+    reset_root()
+    listener = setup_logging(level="INFO", stream=stream, queue_size=args.calls)
+    p50, p99 = measure(args.calls)
+    print(f"{'queue handler':>15}: p50 {p50 * 1e6:7.1f} us, p99 {p99 * 1e6:7.1f} us per call")
+    listener.stop()
+
+
+if __name__ == "__main__":
+    main()
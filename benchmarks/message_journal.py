@@ -0,0 +1,66 @@
+"""Benchmark: messages/sec with per-message commits vs the write-behind journal.
+
+Simulates --users concurrent users, each running --turns chat turns through
+the async facade used by the bot (history read, user message, bot reply).
+
+    python -m benchmarks.message_journal --users 200 --turns 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_db import AsyncDB
+from database import Database
+
+
+async def user_session(db, user_id, turns):
+    for turn in range(turns):
+        await db.get_chat_history(user_id, limit=5)
+        await db.add_message(user_id, f"Сообщение пользователя {turn}", is_bot=False)
+        await db.add_message(user_id, f"Ответ бота {turn}", is_bot=True)
+
+
+async def run(db_file, users, turns, **options):
+    db = AsyncDB(Database(db_file, **options))
+    for user_id in range(users):
+        await db.add_user(user_id, None, None, None)
+    start = time.perf_counter()
+    await asyncio.gather(*(user_session(db, user_id, turns) for user_id in range(users)))
+    await db.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--flush-interval-ms", type=int, default=50)
+    parser.add_argument("--flush-rows", type=int, default=256)
+    args = parser.parse_args()
+
+    messages = args.users * args.turns * 2
+    with tempfile.TemporaryDirectory() as tmp:
+        variants = (
+            ("per-message commit", {}),
+            ("write-behind", {
+                "write_behind": True,
+                "flush_interval": args.flush_interval_ms / 1000,
+                "flush_rows": args.flush_rows,
+            }),
+        )
+        for name, options in variants:
+            db_file = os.path.join(tmp, f"{name}.db")
+            elapsed = asyncio.run(run(db_file, args.users, args.turns, **options))
+            check = Database(db_file)
+            stored = check.conn.fetchone("SELECT COUNT(*) FROM messages")[0]
+            check.close()
+            print(f"{name:>20}: {messages / elapsed:10.1f} messages/s ({stored} stored)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark: vector index build and query time for a user with many messages.
+
+Indexes --messages synthetic messages for one user with the default hashing
+embedder, then reports incremental add throughput, cold load time from
+disk and top-k query latency percentiles.
+
+    python -m benchmarks.retrieval --messages 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import VectorIndex
+
+WORDS = (
+    "тревога сон работа экзамен мама папа друг одиночество страх злость усталость "
+    "радость школа университет деньги отношения ссора расставание переезд здоровье "
+    "врач спорт музыка книги выходные праздник начальник коллега сестра брат кошка"
+).split()
+
+
+def sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 25)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--skip-recent", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as tmp:
+        index = VectorIndex(tmp)
+        user_id = 1
+        index.search(user_id, "прогрев")
+
+        start = time.perf_counter()
+        for i in range(args.messages):
+            index.add(user_id, sentence(rng), i % 2 == 1)
+        elapsed = time.perf_counter() - start
+        print(f"add:   {args.messages / elapsed:10.1f} messages/s")
+
+        cold = VectorIndex(tmp)
+        start = time.perf_counter()
+        cold.search(user_id, sentence(rng), args.k, args.skip_recent)
+        print(f"load:  {(time.perf_counter() - start) * 1000:10.1f} ms for {args.messages} messages")
+
+        latencies = []
+        for _ in range(args.queries):
+            query = sentence(rng)
+            start = time.perf_counter()
+            cold.search(user_id, query, args.k, args.skip_recent)
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        print(f"query: p50 {statistics.median(latencies):8.2f} ms  "
+              f"p95 {latencies[int(len(latencies) * 0.95) - 1]:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
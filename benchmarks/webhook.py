@@ -0,0 +1,181 @@
+"""Benchmark: webhook throughput and reply latency with 1..N worker processes.
+
+Starts a fake Telegram Bot API and a fake completions server, runs the bot
+in webhook mode (`python gbot.py` with WEBHOOK_URL set) against them and
+plays `--users` concurrent users, each sending `--messages` messages and
+waiting for the reply before sending the next one. Latency is measured
+from the webhook POST to the bot's sendMessage for that chat.
+
+    python -m benchmarks.webhook --workers 1,2,4 --users 50 --messages 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_PORT = 18601
+WEBHOOK_PORT = 18610
+
+
+class FakeServers:
+    """Bot API methods answer immediately; completions sleep `llm_latency`."""
+
+    def __init__(self, llm_latency):
+        self.llm_latency = llm_latency
+        self.waiters = defaultdict(deque)
+        self.message_id = 0
+
+    async def telegram(self, request):
+        method = request.match_info["method"].lower()
+        data = dict(await request.post()) if request.content_type != "application/json" else await request.json()
+        chat_id = int(data.get("chat_id", 0) or 0)
+        self.message_id += 1
+        if method == "sendmessage":
+            waiters = self.waiters[chat_id]
+            if waiters:
+                waiters.popleft().set_result(time.perf_counter())
+        if method in ("sendmessage", "editmessagetext"):
+            result = {
+                "message_id": self.message_id, "date": 0, "text": str(data.get("text", "")),
+                "chat": {"id": chat_id, "type": "private"}
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def completions(self, request):
+        await request.read()
+        await asyncio.sleep(self.llm_latency)
+        return web.json_response({"choices": [{"index": 0, "text": " Я тебя слышу. Расскажи подробнее?"}]})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_post("/v1/completions", self.completions)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", FAKE_PORT).start()
+
+    def expect_reply(self, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id].append(future)
+        return future
+
+
+def update(user_id, update_id, text):
+    message = {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+
+async def send(session, fake, counter, user_id, text):
+    counter[0] += 1
+    reply = fake.expect_reply(user_id)
+    start = time.perf_counter()
+    try:
+        async with session.post(f"http://127.0.0.1:{WEBHOOK_PORT}/webhook", json=update(user_id, counter[0], text)) as r:
+            if r.status != 200:
+                raise RuntimeError(f"webhook returned {r.status}")
+    except Exception:
+        fake.waiters[user_id].remove(reply)
+        raise
+    return await asyncio.wait_for(reply, 30) - start
+
+
+async def send_when_ready(session, fake, counter, user_id, text, timeout=120):
+    """Retry until the user's worker is up; workers start in parallel."""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            return await send(session, fake, counter, user_id, text)
+        except (aiohttp.ClientError, RuntimeError):
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def run(args, workers, fake):
+    workdir = tempfile.mkdtemp()
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123456:benchmark",
+        ADMIN_IDS="1",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{FAKE_PORT}",
+        WEBHOOK_URL=f"http://127.0.0.1:{WEBHOOK_PORT}",
+        WEBHOOK_HOST="127.0.0.1",
+        WEBHOOK_PORT=str(WEBHOOK_PORT),
+        WEBHOOK_WORKERS=str(workers),
+        LLM_BACKENDS=json.dumps([{
+            "name": "local", "kind": "completion", "model": "fake",
+            "url": f"http://127.0.0.1:{FAKE_PORT}/v1/completions", "timeout": 30
+        }]),
+        LLM_MAX_CONCURRENCY="1000",
+        SUMMARY_EVERY="0",
+    )
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "gbot.py")],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    counter = [0]
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            users = range(1000, 1000 + args.users)
+            for text in ("/start", "🎁 Попробовать бесплатно"):
+                await asyncio.gather(*(send_when_ready(session, fake, counter, user_id, text) for user_id in users))
+
+            async def user_session(user_id):
+                return [await send(session, fake, counter, user_id, f"сообщение {i}") for i in range(args.messages)]
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*(user_session(user_id) for user_id in users))
+            elapsed = time.perf_counter() - start
+    except Exception:
+        print(f"bot log: {log.name}")
+        raise
+    finally:
+        process.terminate()
+        process.wait(15)
+        log.close()
+
+    latencies = sorted(latency * 1000 for result in results for latency in result)
+    quantile = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+    print(
+        f"workers={workers}: {len(latencies) / elapsed:8.1f} updates/s  "
+        f"p50 {statistics.median(latencies):7.1f} ms  p95 {quantile(0.95):7.1f} ms  p99 {quantile(0.99):7.1f} ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    fake = FakeServers(args.llm_latency)
+    await fake.start()
+    print(f"{os.cpu_count()} CPU(s), LLM latency {args.llm_latency * 1000:.0f} ms")
+    for workers in [int(count) for count in args.workers.split(",")]:
+        await run(args, workers, fake)
+    await fake.runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
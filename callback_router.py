@@ -0,0 +1,44 @@
+from functools import lru_cache
+
+
+class CallbackRouter:
+    """Dispatch callback_data strings through a dict instead of an if/elif chain.
+
+    Data is either an action name ("back_to_settings") or an action followed
+    by "_" and a value ("bot_gender_female"); exact actions win, otherwise
+    the shortest registered prefix is used. Parsed results are memoized, as
+    the set of callback_data strings a bot emits is small.
+    """
+
+    def __init__(self, parse_cache_size=1024):
+        self.handlers = {}
+        self.parse = lru_cache(maxsize=parse_cache_size)(self._parse)
+
+    def add(self, action: str, handler):
+        """`handler(callback_query, value)`; value is None for a bare action."""
+        self.handlers[action] = handler
+        self.parse.cache_clear()
+
+    def route(self, action: str):
+        def decorator(handler):
+            self.add(action, handler)
+            return handler
+        return decorator
+
+    def _parse(self, data: str):
+        if data in self.handlers:
+            return data, None
+        position = data.find("_")
+        while position != -1:
+            if data[:position] in self.handlers:
+                return data[:position], data[position + 1:]
+            position = data.find("_", position + 1)
+        return None, None
+
+    async def dispatch(self, callback_query) -> bool:
+        action, value = self.parse(callback_query.data or "")
+        handler = self.handlers.get(action)
+        if handler is None:
+            return False
+        await handler(callback_query, value)
+        return True
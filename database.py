@@ -1,133 +1,200 @@
-import sqlite3
+import logging
+import db_connection
 from datetime import datetime
+from message_journal import MessageJournal
+from settings_store import SETTINGS_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# Messages are ordered by their AUTOINCREMENT id: it is strictly monotonic,
+# unlike the second-resolution timestamp, and is already stored in every
+# index entry, so (user_id, id) serves the latest-N query without a sort.
+MIGRATIONS = [
+    (
+        'CREATE INDEX IF NOT EXISTS idx_messages_user_id_id ON messages (user_id, id)',
+    ),
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    (
+        'ALTER TABLE users ADD COLUMN age TEXT DEFAULT NULL',
+        "ALTER TABLE users ADD COLUMN style TEXT DEFAULT 'short'",
+        'ALTER TABLE users ADD COLUMN advice BOOLEAN DEFAULT 0',
+    ),
+]
+
+
+def create_users_table(conn):
+    """The `users` table; SubscriptionDB's tables reference it, so it creates it too."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            bot_gender TEXT DEFAULT NULL,
+            user_gender TEXT DEFAULT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
 
 class Database:
-    
-    def __init__(self, db_file="chat_history.db"):
+
+    def __init__(self, db_file="chat_history.db", write_behind=False, flush_interval=0.05, flush_rows=256):
         self.db_file = db_file
+        self.conn = db_connection.acquire(db_file)
         self.init_db()
+        self.journal = MessageJournal(self.conn, flush_interval, flush_rows) if write_behind else None
 
     def init_db(self):
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                bot_gender TEXT DEFAULT NULL,
-                user_gender TEXT DEFAULT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                message_text TEXT,
-                is_bot BOOLEAN,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        with self.conn.transaction() as conn:
+            c = conn.cursor()
+
+            create_users_table(c)
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    message_text TEXT,
+                    is_bot BOOLEAN,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+
+        db_connection.migrate(self.conn, "chat_history", MIGRATIONS)
 
     def add_user(self, user_id, username, first_name, last_name, bot_gender=None, user_gender=None):
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute('''
+        self.conn.execute('''
             INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, bot_gender, user_gender)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (user_id, username, first_name, last_name, bot_gender, user_gender))
-        
-        conn.commit()
-        conn.close()
 
     def add_message(self, user_id: int, message_text: str, is_bot: bool):
+        if self.journal is not None:
+            self.journal.append(user_id, message_text, is_bot)
+            return
         try:
-            conn = sqlite3.connect(self.db_file)
-            c = conn.cursor()
-            
-            c.execute('''
-                INSERT INTO messages (user_id, message_text, is_bot, timestamp)
-                VALUES (?, ?, ?, datetime('now'))
-            ''', (user_id, message_text, is_bot))
-            
-            conn.commit()
-            conn.close()
+            # messages.user_id references users, and foreign keys are enforced.
+            with self.conn.transaction() as conn:
+                conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+                conn.execute('''
+                    INSERT INTO messages (user_id, message_text, is_bot, timestamp)
+                    VALUES (?, ?, ?, datetime('now'))
+                ''', (user_id, message_text, is_bot))
         except Exception as e:
-            print(f"Error adding message: {e}")
+            logger.error(f"Error adding message: {e}")
 
     def get_chat_history(self, user_id: int, limit: int = 10) -> list:
+        """Return the user's latest `limit` messages, oldest first."""
+        if self.journal is not None:
+            with self.journal.lock:
+                pending = self.journal.pending(user_id)
+                stored = self._fetch_history(user_id, max(limit - len(pending), 0))
+            return (stored + pending)[-limit:] if limit > 0 else []
+        return self._fetch_history(user_id, limit)
+
+    def _fetch_history(self, user_id: int, limit: int) -> list:
+        if limit <= 0:
+            return []
         try:
-            conn = sqlite3.connect(self.db_file)
-            c = conn.cursor()
-            
-            c.execute('''
+            messages = self.conn.fetchall('''
                 SELECT message_text, is_bot, timestamp
                 FROM messages
                 WHERE user_id = ?
-                ORDER BY timestamp DESC
+                ORDER BY id DESC
                 LIMIT ?
             ''', (user_id, limit))
-            
-            messages = c.fetchall()
-            conn.close()
-            
-            return messages[::-1] 
+
+            return messages[::-1]
         except Exception as e:
-            print(f"Error getting chat history: {e}")
+            logger.error(f"Error getting chat history: {e}")
             return []
 
     def clear_chat_history(self, user_id: int):
+        if self.journal is not None:
+            self.journal.discard(user_id)
         try:
-            conn = sqlite3.connect(self.db_file)
-            c = conn.cursor()
-            
-            c.execute('''
-                DELETE FROM messages
-                WHERE user_id = ?
-            ''', (user_id,))
-            
-            conn.commit()
-            conn.close()
+            with self.conn.transaction() as conn:
+                conn.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
+                conn.execute('DELETE FROM summaries WHERE user_id = ?', (user_id,))
         except Exception as e:
-            print(f"Error clearing chat history: {e}")
-
-    def update_user_setting(self, user_id: int, setting_name: str, setting_value):
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute(f'''
-            UPDATE users 
-            SET {setting_name} = ?
+            logger.error(f"Error clearing chat history: {e}")
+
+    def get_summary(self, user_id: int):
+        """Return (summary, last_message_id) or None."""
+        return self.conn.fetchone('''
+            SELECT summary, last_message_id
+            FROM summaries
             WHERE user_id = ?
-        ''', (setting_value, user_id))
-        
-        conn.commit()
-        conn.close()
+        ''', (user_id,))
+
+    def save_summary(self, user_id: int, summary: str, last_message_id: int):
+        self.conn.execute('''
+            INSERT INTO summaries (user_id, summary, last_message_id, updated_at)
+            VALUES (?, ?, ?, datetime('now'))
+            ON CONFLICT (user_id) DO UPDATE SET
+                summary = excluded.summary,
+                last_message_id = excluded.last_message_id,
+                updated_at = excluded.updated_at
+        ''', (user_id, summary, last_message_id))
+
+    def get_messages_to_summarize(self, user_id: int, after_id: int, keep_recent: int, limit: int = 200) -> list:
+        """Messages after `after_id` that are older than the newest `keep_recent`.
+
+        Returns (id, message_text, is_bot) rows, oldest first.
+        """
+        boundary = self.conn.fetchone('''
+            SELECT id
+            FROM messages
+            WHERE user_id = ?
+            ORDER BY id DESC
+            LIMIT 1 OFFSET ?
+        ''', (user_id, keep_recent - 1)) if keep_recent > 0 else (float("inf"),)
+        if not boundary:
+            return []
+        return self.conn.fetchall('''
+            SELECT id, message_text, is_bot
+            FROM messages
+            WHERE user_id = ? AND id > ? AND id < ?
+            ORDER BY id
+            LIMIT ?
+        ''', (user_id, after_id, boundary[0], limit))
+
+    def save_user_settings(self, user_id: int, settings: dict):
+        """Upsert the given settings columns; creates the user row if needed."""
+        columns = [name for name in settings if name in SETTINGS_FIELDS]
+        if not columns:
+            return
+        self.conn.execute(f'''
+            INSERT INTO users (user_id, {", ".join(columns)})
+            VALUES (?{", ?" * len(columns)})
+            ON CONFLICT (user_id) DO UPDATE SET
+                {", ".join(f"{name} = excluded.{name}" for name in columns)}
+        ''', (user_id, *(settings[name] for name in columns)))
 
     def get_user_settings(self, user_id: int):
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute('''
-            SELECT bot_gender, user_gender
+        """Return (age, style, advice, bot_gender, user_gender) or None."""
+        return self.conn.fetchone(f'''
+            SELECT {", ".join(SETTINGS_FIELDS)}
             FROM users
             WHERE user_id = ?
         ''', (user_id,))
-        
-        settings = c.fetchone()
-        conn.close()
-        return settings
 
     def close(self):
         """Close the database connection"""
-        conn = sqlite3.connect(self.db_file)
-        conn.close() 
\ No newline at end of file
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.conn is not None:
+            db_connection.release(self.conn)
+            self.conn = None
@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -20000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+)
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+class ConnectionManager:
+    """Long-lived SQLite connection shared by everything that uses one file.
+
+    The connection runs in WAL mode with relaxed fsyncs and keeps compiled
+    statements in sqlite3's statement cache, so repeated queries skip the
+    parser. All access is serialized through a re-entrant lock.
+    """
+
+    def __init__(self, db_file, cached_statements=256):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self.refs = 0
+        self.conn = sqlite3.connect(
+            db_file,
+            check_same_thread=False,
+            cached_statements=cached_statements
+        )
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+
+    def execute(self, sql, params=()) -> int:
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def executemany(self, sql, seq_of_params) -> int:
+        with self.transaction() as conn:
+            return conn.executemany(sql, seq_of_params).rowcount
+
+    def fetchone(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()) -> list:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """Run several statements under the lock and commit them together."""
+        with self.lock:
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.rollback()
+                raise
+            else:
+                self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def migrate(manager: ConnectionManager, component: str, migrations):
+    """Bring `component`'s schema up to date.
+
+    `migrations` is an ordered list; each entry is a tuple of SQL strings or
+    callables taking the connection. Entries past the stored version are
+    applied in order, each in its own transaction, and the version is
+    recorded in `schema_migrations`, so several components can share a file.
+    """
+    with manager.lock:
+        conn = manager.conn
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                component TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            )
+        ''')
+        conn.commit()
+        row = conn.execute(
+            'SELECT version FROM schema_migrations WHERE component = ?', (component,)
+        ).fetchone()
+        version = row[0] if row else 0
+
+        for number, steps in enumerate(migrations[version:], start=version + 1):
+            conn.execute("BEGIN")
+            try:
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute('''
+                    INSERT INTO schema_migrations (component, version) VALUES (?, ?)
+                    ON CONFLICT (component) DO UPDATE SET version = excluded.version
+                ''', (component, number))
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+
+def _key(db_file):
+    return db_file if db_file == ":memory:" else os.path.abspath(db_file)
+
+
+def acquire(db_file) -> ConnectionManager:
+    """Return the shared manager for `db_file`, opening it on first use."""
+    key = _key(db_file)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None or key == ":memory:":
+            manager = ConnectionManager(db_file)
+            if key != ":memory:":
+                _managers[key] = manager
+        manager.refs += 1
+        return manager
+
+
+def release(manager: ConnectionManager):
+    """Drop one reference; the connection is closed when nobody uses it."""
+    key = _key(manager.db_file)
+    with _managers_lock:
+        manager.refs -= 1
+        if manager.refs > 0:
+            return
+        if _managers.get(key) is manager:
+            del _managers[key]
+    manager.close()
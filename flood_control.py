@@ -0,0 +1,131 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+
+
+class _Flow:
+    __slots__ = ("tokens", "updated", "seen", "batch", "turn")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+        self.seen = now
+        self.batch = None
+        self.turn = None
+
+
+class _Batch:
+    __slots__ = ("messages", "started", "deadline")
+
+    def __init__(self, message, now, deadline):
+        self.messages = [message]
+        self.started = now
+        self.deadline = deadline
+
+
+class FloodControl(BaseMiddleware):
+    """Merges a user's rapid messages into one handler call.
+
+    A user has at most one turn (handler call) running at a time. A
+    mergeable message opens a batch that starts as soon as the user's
+    previous turn has finished and a token is in the user's bucket (`rate`
+    turns per second, `burst` at once), so a lone message is handled right
+    away. Messages arriving while the batch waits join it, and the handler
+    then runs once for the last of them, with all of them in
+    `merged_messages`. With `debounce`, a batch also waits that long after
+    its latest message, up to `max_delay` after the first. A full batch
+    (`max_batch`) is closed and the next message opens a new one.
+
+    Per-user state is a few numbers, kept for at most `max_users` users and
+    dropped after `idle_ttl` seconds without messages.
+    """
+
+    def __init__(self, rate=0.5, burst=3, debounce=0.0, max_delay=3.0, max_batch=10,
+                 max_users=100_000, idle_ttl=600, should_merge=None):
+        self.rate = rate
+        self.burst = burst
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.should_merge = should_merge
+        self._flows = OrderedDict()
+        self.batches = 0
+        self.merged = 0
+        self.throttled = 0
+
+    def _flow(self, user_id, now) -> _Flow:
+        """The user's state, most recently seen last; evicts idle users from the front."""
+        flow = self._flows.get(user_id)
+        if flow is None:
+            flow = self._flows[user_id] = _Flow(self.burst, now)
+        else:
+            self._flows.move_to_end(user_id)
+        flow.seen = now
+        while self._flows:
+            oldest = next(iter(self._flows.values()))
+            if len(self._flows) <= self.max_users and now - oldest.seen <= self.idle_ttl:
+                break
+            self._flows.popitem(last=False)
+        return flow
+
+    async def __call__(self, handler, event, data):
+        if (
+            not isinstance(event, Message)
+            or event.from_user is None
+            or (self.should_merge is not None and not self.should_merge(event))
+        ):
+            return await handler(event, data)
+
+        now = time.monotonic()
+        flow = self._flow(event.from_user.id, now)
+        batch = flow.batch
+        if batch is not None and len(batch.messages) < self.max_batch:
+            batch.messages.append(event)
+            batch.deadline = min(now + self.debounce, batch.started + self.max_delay)
+            self.merged += 1
+            return None
+
+        batch = flow.batch = _Batch(event, now, now + self.debounce)
+        self.batches += 1
+        throttled = False
+        while True:
+            now = time.monotonic()
+            flow.tokens = min(self.burst, flow.tokens + (now - flow.updated) * self.rate)
+            flow.updated = now
+            if flow.turn is not None:
+                await asyncio.shield(flow.turn)
+                continue
+            wait = batch.deadline - now
+            if wait <= 0:
+                if flow.tokens >= 1:
+                    break
+                wait = (1 - flow.tokens) / self.rate
+                throttled = True
+            await asyncio.sleep(wait)
+        flow.tokens -= 1
+        if throttled:
+            self.throttled += 1
+        if flow.batch is batch:
+            flow.batch = None
+
+        turn = flow.turn = asyncio.get_running_loop().create_future()
+        data["merged_messages"] = batch.messages
+        try:
+            return await handler(batch.messages[-1], data)
+        finally:
+            if flow.turn is turn:
+                flow.turn = None
+            turn.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._flows),
+            "batches": self.batches,
+            "merged": self.merged,
+            "throttled": self.throttled,
+        }
@@ -1,37 +1,250 @@
 import asyncio
+import csv
+import io
+import json
 import logging
+import re
+import time
+from datetime import datetime
+from functools import lru_cache, partial
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-import requests
+from aiogram.types import BufferedInputFile, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from async_db import AsyncDB
+from callback_router import CallbackRouter
 from database import Database
+from flood_control import FloodControl
+from llm_batcher import CompletionBatcher
+from llm_client import LLMBackend, LLMClient
+from llm_router import BackendHealth, LLMRoute, LLMRouter
+from llm_scheduler import LLMScheduler, Superseded
+from log_setup import parse_categories, setup_logging
+from metrics import Metrics
+from outbox import Outbox
+from prompt_builder import PromptBuilder
+from scheduler import Scheduler
+from settings_store import SettingsStore
+from state_store import MemoryStateStore, SQLiteStateStore
+from streaming import StreamingReply
+from summarizer import Summarizer
+from subscription_cache import SubscriptionCache
 from subscription_db import SubscriptionDB
+from trial_notifier import TrialNotifier
+import webhook
 from dotenv import load_dotenv
 import os
-import sys
+import pytz
 
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG, stream=sys.stdout)
+# JSON logs written by a background thread. LOG_LEVELS and LOG_SAMPLE take
+# "logger=value" pairs, e.g. LOG_LEVELS="llm_router=DEBUG" and
+# LOG_SAMPLE="aiogram.event=0.01" (keep 1% of its records below WARNING).
+# Message texts are logged as their length unless LOG_CONTENT=1.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = parse_categories(os.getenv("LOG_LEVELS", ""))
+LOG_SAMPLE = parse_categories(os.getenv("LOG_SAMPLE", "aiogram.event=0.01"))
+LOG_CONTENT = os.getenv("LOG_CONTENT", "0") == "1"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+setup_logging(
+    level=LOG_LEVEL,
+    levels=LOG_LEVELS,
+    sample=LOG_SAMPLE,
+    redact=not LOG_CONTENT,
+    queue_size=LOG_QUEUE_SIZE
+)
+logger = logging.getLogger("gbot")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT")
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_KEY")
 
 LOCAL_API_URL = os.getenv("API_URL")
-DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
+DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
 
 ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS").split(",")]
 
-bot = Bot(token=BOT_TOKEN)
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "3"))
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "100"))
+LOCAL_API_TIMEOUT = float(os.getenv("LOCAL_API_TIMEOUT", "10"))
+DEEPSEEK_API_TIMEOUT = float(os.getenv("DEEPSEEK_API_TIMEOUT", "60"))
+HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", "20"))
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS", "1500"))
+SUMMARY_EVERY = int(os.getenv("SUMMARY_EVERY", "20"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "0"))
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "100000"))
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", "100000"))
+# "memory" keeps conversation state per process; "sqlite" shares it
+# between processes and hosts using STATE_DB_FILE.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "state.db")
+ADMIN_STATE_TTL = int(os.getenv("ADMIN_STATE_TTL", "600"))
+TRIAL_NOTICES = os.getenv("TRIAL_NOTICES", "1") == "1"
+# Hours before the end of a trial to remind the user (0: only the "ended" notice).
+TRIAL_REMINDER_HOURS = float(os.getenv("TRIAL_REMINDER_HOURS", "24"))
+KEYS_BATCH_MAX = int(os.getenv("KEYS_BATCH_MAX", "100000"))
+KEYS_MAX_DAYS = int(os.getenv("KEYS_MAX_DAYS", "3650"))
+# Messages a user sends while their previous turn is still being answered
+# are answered together in one LLM turn; turns per user are limited to
+# FLOOD_RATE per second. FLOOD_DEBOUNCE_MS also holds every turn back that
+# long to wait for more messages.
+FLOOD_CONTROL = os.getenv("FLOOD_CONTROL", "1") == "1"
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "0.5"))
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "3"))
+FLOOD_DEBOUNCE_MS = int(os.getenv("FLOOD_DEBOUNCE_MS", "0"))
+FLOOD_MAX_DELAY_MS = int(os.getenv("FLOOD_MAX_DELAY_MS", "3000"))
+FLOOD_MAX_BATCH = int(os.getenv("FLOOD_MAX_BATCH", "10"))
+FLOOD_IDLE_TTL = int(os.getenv("FLOOD_IDLE_TTL", "600"))
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "0") == "1"
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "50"))
+MESSAGE_FLUSH_ROWS = int(os.getenv("MESSAGE_FLUSH_ROWS", "256"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LOCAL_BATCH_WINDOW_MS = int(os.getenv("LOCAL_BATCH_WINDOW_MS", "0"))
+LOCAL_BATCH_SIZE = int(os.getenv("LOCAL_BATCH_SIZE", "8"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "3"))
+LLM_CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", "30"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+# Webhook mode is used when WEBHOOK_URL (the public base URL) is set;
+# otherwise the bot long-polls.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Prometheus text metrics on http://METRICS_HOST:METRICS_PORT/metrics (0: off).
+# Webhook worker processes serve /metrics on their own port instead.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Backends in priority order. LLM_BACKENDS may replace this list with JSON of
+# the same shape; "kind" is "completion" (prompt) or "chat" (messages).
+LLM_BACKENDS = json.loads(os.getenv("LLM_BACKENDS", "null")) or [
+    {
+        "name": "local",
+        "kind": "completion",
+        "url": f"{LOCAL_API_URL}/v1/completions",
+        "model": "google/gemma-3-12b",
+        "timeout": LOCAL_API_TIMEOUT
+    },
+    {
+        "name": "deepseek",
+        "kind": "chat",
+        "url": DEEPSEEK_API_URL,
+        "model": "deepseek-chat",
+        "timeout": DEEPSEEK_API_TIMEOUT,
+        "api_key_env": "DEEPSEEK_KEY"
+    }
+]
+
+metrics = Metrics()
+metrics_runner = None
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+outbox = Outbox(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    max_retries=TELEGRAM_MAX_RETRIES,
+    metrics=metrics
+)
+bot.session.middleware(outbox)
 dp = Dispatcher()
-db = Database()
-sub_db = SubscriptionDB()
-
-user_settings = {}
-
-admin_states = {}
 
+MAIN_MENU_BUTTONS = frozenset(("⚙️ Настройки", "❓ Помощь", "🎁 Попробовать бесплатно", "🔑 Активировать ключ"))
+
+def is_chat_message(message: types.Message) -> bool:
+    """Text for the model, as opposed to commands and menu buttons."""
+    return bool(message.text) and not message.text.startswith("/") and message.text not in MAIN_MENU_BUTTONS
+
+flood_control = FloodControl(
+    rate=FLOOD_RATE,
+    burst=FLOOD_BURST,
+    debounce=FLOOD_DEBOUNCE_MS / 1000,
+    max_delay=FLOOD_MAX_DELAY_MS / 1000,
+    max_batch=FLOOD_MAX_BATCH,
+    idle_ttl=FLOOD_IDLE_TTL,
+    should_merge=is_chat_message
+) if FLOOD_CONTROL else None
+if flood_control:
+    dp.message.middleware(flood_control)
+vector_index = None
+if RETRIEVAL_TOP_K > 0:
+    from retrieval import VectorIndex
+    # Its own thread: a cold load or a search must not hold up chat-db calls.
+    vector_index = AsyncDB(VectorIndex("chat_history_vectors"), name="retrieval")
+db = AsyncDB(
+    Database(
+        write_behind=MESSAGE_WRITE_BEHIND,
+        flush_interval=MESSAGE_FLUSH_INTERVAL_MS / 1000,
+        flush_rows=MESSAGE_FLUSH_ROWS
+    ),
+    name="chat-db"
+)
+sub_cache = SubscriptionCache(max_users=SUBSCRIPTION_CACHE_SIZE)
+sub_db = AsyncDB(SubscriptionDB(cache=sub_cache), name="sub-db")
+scheduler = Scheduler()
+llm = LLMClient([
+    LLMBackend(
+        backend["name"],
+        backend["url"],
+        headers={"Authorization": f"Bearer {os.getenv(backend['api_key_env'])}"} if backend.get("api_key_env") else None,
+        connect_timeout=LLM_CONNECT_TIMEOUT,
+        read_timeout=backend.get("timeout", 60),
+        pool_size=LLM_POOL_SIZE
+    )
+    for backend in LLM_BACKENDS
+])
+llm_router = LLMRouter(
+    llm,
+    [
+        LLMRoute(
+            backend["name"],
+            backend["kind"],
+            backend["model"],
+            health=BackendHealth(max_consecutive_failures=LLM_CIRCUIT_FAILURES, cooldown=LLM_CIRCUIT_COOLDOWN),
+            batcher=CompletionBatcher(
+                llm, backend["name"], window=LOCAL_BATCH_WINDOW_MS / 1000, max_batch=LOCAL_BATCH_SIZE
+            ) if backend["kind"] == "completion" and LOCAL_BATCH_WINDOW_MS > 0 else None
+        )
+        for backend in LLM_BACKENDS
+    ],
+    hedge=LLM_HEDGE,
+    metrics=metrics
+)
+llm_scheduler = LLMScheduler(max_concurrency=LLM_MAX_CONCURRENCY)
+prompt_builder = PromptBuilder(SYSTEM_PROMPT, history_tokens=PROMPT_HISTORY_TOKENS)
+summarizer = Summarizer(
+    db, llm_router, llm_scheduler, every=SUMMARY_EVERY, keep_recent=HISTORY_LIMIT, builder=prompt_builder,
+    max_users=SETTINGS_CACHE_SIZE
+) if SUMMARY_EVERY > 0 else None
+
+settings_store = SettingsStore(db, max_users=SETTINGS_CACHE_SIZE)
+
+state_store = (
+    AsyncDB(SQLiteStateStore(STATE_DB_FILE), name="state-db") if STATE_BACKEND == "sqlite"
+    else MemoryStateStore()
+)
+
+async def send_trial_notice(user_id, text):
+    await bot.send_message(user_id, text, parse_mode="Markdown", reply_markup=get_main_keyboard())
+
+trial_notifier = TrialNotifier(
+    sub_db, sub_cache, scheduler, send_trial_notice, remind_before=int(TRIAL_REMINDER_HOURS * 3600)
+) if TRIAL_NOTICES else None
+
+@lru_cache(maxsize=None)
 def get_main_keyboard():
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
@@ -43,6 +256,7 @@ def get_main_keyboard():
     )
     return keyboard
 
+@lru_cache(maxsize=None)
 def get_settings_keyboard():
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -56,104 +270,46 @@ def get_settings_keyboard():
     )
     return keyboard
 
-def get_age_keyboard(user_id):
-    current_age = user_settings[user_id]["age"] if user_id in user_settings else None
-    
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if current_age == '13-18' else ''}13-18 лет",
-                callback_data="age_13_18"
-            )],
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if current_age == '19-35' else ''}19-35 лет",
-                callback_data="age_19_35"
-            )],
-            [InlineKeyboardButton(text="Назад", callback_data="back_to_settings")]
-        ]
-    )
-    return keyboard
-
-def get_style_keyboard(user_id):
-    current_style = user_settings[user_id]["style"] if user_id in user_settings else "short"
-    
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if current_style == 'short' else ''}Кратко",
-                callback_data="style_short"
-            )],
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if current_style == 'long' else ''}Развёрнуто",
-                callback_data="style_long"
-            )],
-            [InlineKeyboardButton(text="Назад", callback_data="back_to_settings")]
-        ]
-    )
-    return keyboard
-
-def get_advice_keyboard(user_id):
-    current_advice = user_settings[user_id]["advice"] if user_id in user_settings else False
-    
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if current_advice else ''}Да",
-                callback_data="advice_yes"
-            )],
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if not current_advice else ''}Нет",
-                callback_data="advice_no"
-            )],
-            [InlineKeyboardButton(text="Назад", callback_data="back_to_settings")]
-        ]
-    )
-    return keyboard
-
-def get_bot_gender_keyboard(user_id):
-    current_bot_gender = user_settings[user_id]["bot_gender"] if user_id in user_settings else None
-    
+GENDER_OPTIONS = (
+    ("female", "female", "Женский"),
+    ("male", "male", "Мужской"),
+    ("neutral", "neutral", "Нейтральный"),
+)
+
+# field -> (menu title, options); each option is (callback value, stored value, label)
+SETTINGS_MENUS = {
+    "age": ("Выберите ваш возраст:", (
+        ("13_18", "13-18", "13-18 лет"),
+        ("19_35", "19-35", "19-35 лет"),
+    )),
+    "style": ("Выберите стиль ответов:", (
+        ("short", "short", "Кратко"),
+        ("long", "long", "Развёрнуто"),
+    )),
+    "advice": ("Хотите ли вы получать советы?", (
+        ("yes", True, "Да"),
+        ("no", False, "Нет"),
+    )),
+    "bot_gender": ("Выберите пол бота:", GENDER_OPTIONS),
+    "user_gender": ("Укажите ваш пол:", GENDER_OPTIONS),
+}
+
+@lru_cache(maxsize=None)
+def get_setting_keyboard(field, current):
+    """Keyboards are immutable once sent, so one per (field, checked value) is reused."""
+    _, options = SETTINGS_MENUS[field]
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(
-                text=f"{'✅ ' if current_bot_gender == 'female' else ''}Женский",
-                callback_data="bot_gender_female"
-            )],
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if current_bot_gender == 'male' else ''}Мужской",
-                callback_data="bot_gender_male"
-            )],
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if current_bot_gender == 'neutral' else ''}Нейтральный",
-                callback_data="bot_gender_neutral"
-            )],
-            [InlineKeyboardButton(text="Назад", callback_data="back_to_settings")]
-        ]
-    )
-    return keyboard
-
-def get_user_gender_keyboard(user_id):
-    current_user_gender = user_settings[user_id]["user_gender"] if user_id in user_settings else None
-    
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if current_user_gender == 'female' else ''}Женский",
-                callback_data="user_gender_female"
-            )],
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if current_user_gender == 'male' else ''}Мужской",
-                callback_data="user_gender_male"
-            )],
-            [InlineKeyboardButton(
-                text=f"{'✅ ' if current_user_gender == 'neutral' else ''}Нейтральный",
-                callback_data="user_gender_neutral"
-            )],
-            [InlineKeyboardButton(text="Назад", callback_data="back_to_settings")]
-        ]
+                text=f"{'✅ ' if current == stored else ''}{label}",
+                callback_data=f"{field}_{value}"
+            )]
+            for value, stored, label in options
+        ] + [[InlineKeyboardButton(text="Назад", callback_data="back_to_settings")]]
     )
     return keyboard
 
+@lru_cache(maxsize=None)
 def get_admin_keyboard():
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -167,15 +323,7 @@ def get_admin_keyboard():
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     user_id = message.from_user.id
-    user_settings[user_id] = {
-        "age": None,
-        "style": "short",
-        "advice": False,
-        "bot_gender": "neutral",
-        "user_gender": "neutral"
-    }
-    
-    db.add_user(
+    await db.add_user(
         user_id=user_id,
         username=message.from_user.username,
         first_name=message.from_user.first_name,
@@ -183,7 +331,8 @@ async def cmd_start(message: types.Message):
         bot_gender="neutral",
         user_gender="neutral"
     )
-    sub_db.add_user(user_id)
+    settings_store.invalidate(user_id)
+    await sub_db.add_user(user_id)
     
     welcome_text = """
 *Привет!* 👋 
@@ -211,13 +360,144 @@ async def cmd_admin(message: types.Message):
     user_id = message.from_user.id
     if user_id in ADMIN_IDS:
         await message.answer(
-            "*Панель администратора* 🔒\n\nВыберите действие:",
+            "*Панель администратора* 🔒\n\n"
+            "Выпуск ключей: `/keys N [партия] [дней]`\n"
+            "Отзыв неиспользованных ключей партии: `/revoke_keys партия`\n"
+            "Задержки по этапам: `/stats`\n\n"
+            "Выберите действие:",
             parse_mode="Markdown",
             reply_markup=get_admin_keyboard()
         )
     else:
         await message.reply("У вас нет доступа к этой команде.")
 
+BATCH_LABEL_RE = re.compile(r"^[\w-]{1,64}$")
+
+@dp.message(Command("keys"))
+async def cmd_keys(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.reply("У вас нет доступа к этой команде.")
+        return
+    args = message.text.split()[1:]
+    try:
+        count = int(args[0])
+        batch = args[1] if len(args) > 1 else None
+        days = int(args[2]) if len(args) > 2 else None
+    except (IndexError, ValueError):
+        count = 0
+    if (
+        not 0 < count <= KEYS_BATCH_MAX
+        or (batch and not BATCH_LABEL_RE.match(batch))
+        or (days is not None and not 0 < days <= KEYS_MAX_DAYS)
+    ):
+        await message.answer(
+            f"Использование: `/keys N [партия] [дней]`, N от 1 до {KEYS_BATCH_MAX}, "
+            f"партия — буквы, цифры, `_` и `-`, дней от 1 до {KEYS_MAX_DAYS}.",
+            parse_mode="Markdown"
+        )
+        return
+
+    expires_at = int(time.time()) + days * 86400 if days else None
+    keys = await sub_db.create_activation_keys(count, batch=batch, expires_at=expires_at)
+    expires = datetime.fromtimestamp(expires_at, pytz.timezone('Europe/Moscow')).isoformat() if expires_at else ""
+    document = io.StringIO()
+    writer = csv.writer(document)
+    writer.writerow(["key", "batch", "expires_at"])
+    writer.writerows((key, batch or "", expires) for key in keys)
+    await message.answer_document(
+        BufferedInputFile(document.getvalue().encode("utf-8"), filename=f"keys_{batch or 'batch'}.csv"),
+        caption=f"🔑 Выпущено ключей: {count}"
+    )
+
+@dp.message(Command("revoke_keys"))
+async def cmd_revoke_keys(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.reply("У вас нет доступа к этой команде.")
+        return
+    args = message.text.split()[1:]
+    if len(args) != 1 or not BATCH_LABEL_RE.match(args[0]):
+        await message.answer("Использование: `/revoke_keys партия`", parse_mode="Markdown")
+        return
+    revoked = await sub_db.revoke_batch(args[0])
+    await message.answer(f"Отозвано неиспользованных ключей: {revoked}")
+
+@dp.message(Command("queue"))
+async def cmd_queue(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.reply("У вас нет доступа к этой команде.")
+        return
+    stats = llm_scheduler.stats()
+    sending = outbox.stats()
+    flooding = flood_control.stats() if flood_control else None
+    await message.answer(
+        "*Очередь генераций* 📊\n\n"
+        f"Лимит: {stats['max_concurrency']}\n"
+        f"Выполняется: {stats['running']}\n"
+        f"В очереди: {stats['queued']}\n"
+        f"Фоновые задачи: {stats['background']}\n"
+        f"Всего запусков: {stats['granted']}\n"
+        f"Заменено новыми: {stats['superseded']}\n"
+        f"Среднее ожидание: {stats['avg_wait']:.2f} с\n"
+        f"Максимальное ожидание: {stats['max_wait']:.2f} с\n\n"
+        + "\n".join(
+            f"{backend['name']}: {'🔴' if backend['open'] else '🟢'} "
+            f"ошибки {backend['error_rate']:.0%}, "
+            f"p95 {backend['p95'] or 0:.2f} с"
+            for backend in llm_router.stats()
+        )
+        + "\n\n*Отправка в Telegram*\n"
+        f"В очереди: {sending['queued']}\n"
+        f"Отправлено: {sending['sent']}\n"
+        f"Повторов после 429: {sending['retried']}\n"
+        f"Ожидание: среднее {sending['avg_wait']:.2f} с, p95 {sending['p95_wait']:.2f} с, "
+        f"макс. {sending['max_wait']:.2f} с"
+        + (
+            "\n\n*Антифлуд*\n"
+            f"Ходов модели: {flooding['batches']}\n"
+            f"Объединено сообщений: {flooding['merged']}\n"
+            f"Задержано лимитом: {flooding['throttled']}\n"
+            f"Пользователей в памяти: {flooding['users']}"
+            if flooding else ""
+        ),
+        parse_mode="Markdown"
+    )
+
+STATS_STAGES = ("subscription", "settings", "history", "retrieval", "store", "prompt", "llm", "stream", "send", "total")
+
+def format_seconds(value):
+    return "—" if value is None else "∞" if value == float("inf") else f"{value:g}"
+
+def format_histogram(name, histogram):
+    return (
+        f"`{name}`: p50 ≤{format_seconds(histogram.quantile(0.5))} с, "
+        f"p95 ≤{format_seconds(histogram.quantile(0.95))} с, {histogram.count} шт."
+    )
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.reply("У вас нет доступа к этой команде.")
+        return
+    stages = {labels["stage"]: histogram for labels, histogram in metrics.histograms("stage_seconds")}
+    answers = metrics.counter("llm_answers_total")
+    fallbacks = metrics.counter("llm_fallbacks_total")
+    lines = ["*Задержки по этапам* ⏱"]
+    lines += [format_histogram(stage, stages[stage]) for stage in STATS_STAGES if stage in stages]
+    lines.append("\n*LLM-бэкенды*")
+    lines += [
+        format_histogram(labels["backend"], histogram)
+        + f", ошибок {metrics.counter('llm_requests_total', backend=labels['backend'], result='error')}"
+        for labels, histogram in metrics.histograms("llm_backend_seconds")
+    ]
+    lines.append(f"Ответы запасных бэкендов: {fallbacks / answers if answers else 0:.1%} ({fallbacks} из {answers})")
+    lines.append("\n*Telegram API*")
+    lines += [format_histogram(labels["method"], histogram) for labels, histogram in metrics.histograms("telegram_seconds")]
+    lines.append(
+        f"\nОшибок обработки: {metrics.counter('errors_total')}, "
+        f"ошибок Telegram: {metrics.counter('telegram_errors_total')}"
+    )
+    await message.answer("\n".join(lines), parse_mode="Markdown")
+
 @dp.message(Command("help"))
 async def cmd_help(message: types.Message):
     help_text = """
@@ -229,115 +509,136 @@ async def cmd_help(message: types.Message):
 """
     await message.answer(help_text, parse_mode="Markdown")
 
+async def show_setting_menu(field, callback_query: types.CallbackQuery, value):
+    user_id = callback_query.from_user.id
+    title, options = SETTINGS_MENUS[field]
+    if value is not None:
+        stored = next((stored for option, stored, _ in options if option == value), None)
+        if stored is None:
+            return
+        await settings_store.update(user_id, **{field: stored})
+    settings = await settings_store.get(user_id)
+    await callback_query.message.edit_text(
+        title,
+        reply_markup=get_setting_keyboard(field, getattr(settings, field))
+    )
+
+callbacks = CallbackRouter()
+for field in SETTINGS_MENUS:
+    callbacks.add(field, partial(show_setting_menu, field))
+
+@callbacks.route("back_to_settings")
+async def on_back_to_settings(callback_query: types.CallbackQuery, value):
+    await callback_query.message.edit_text(
+        "⚙️ Настройки",
+        reply_markup=get_settings_keyboard()
+    )
+
+@callbacks.route("back_to_main")
+async def on_back_to_main(callback_query: types.CallbackQuery, value):
+    await callback_query.message.delete()
+    await callback_query.message.answer(
+        "Настройки сохранены",
+        reply_markup=get_main_keyboard()
+    )
+
+@callbacks.route("admin_create_key")
+async def on_admin_create_key(callback_query: types.CallbackQuery, value):
+    if callback_query.from_user.id in ADMIN_IDS:
+        new_key = await sub_db.create_activation_key()
+        await callback_query.message.answer(f"🔑 Новый ключ активации: `{new_key}`", parse_mode="Markdown")
+    else:
+        await callback_query.answer("У вас нет доступа к этой функции.")
+
+@callbacks.route("admin_delete_key")
+async def on_admin_delete_key(callback_query: types.CallbackQuery, value):
+    user_id = callback_query.from_user.id
+    if user_id in ADMIN_IDS:
+        await state_store.set(f"admin_state:{user_id}", "waiting_for_key_to_delete", ttl=ADMIN_STATE_TTL)
+        await callback_query.message.answer("Введите ключ, который хотите удалить:")
+    else:
+        await callback_query.answer("У вас нет доступа к этой функции.")
+
 @dp.callback_query()
 async def process_callback(callback_query: types.CallbackQuery):
-    user_id = callback_query.from_user.id
-    if user_id not in user_settings:
-        user_settings[user_id] = {
-            "age": None,
-            "style": "short",
-            "advice": False,
-            "bot_gender": None,
-            "user_gender": None
+    await callbacks.dispatch(callback_query)
+
+def build_payloads(prompt):
+    """The same request for every backend kind the router may pick."""
+    return {
+        "completion": {
+            "prompt": prompt.completion(),
+            "temperature": 0.7,
+            "max_tokens": 1000,
+            "top_p": 0.9,
+            "frequency_penalty": 0.0,
+            "presence_penalty": 0.0,
+            "stop": ["Пользователь:", "Система:"]
+        },
+        "chat": {
+            "messages": prompt.chat_messages(),
+            "temperature": 0.7,
+            "max_tokens": 1000
         }
+    }
 
-    if callback_query.data == "age":
-        await callback_query.message.edit_text(
-            "Выберите ваш возраст:",
-            reply_markup=get_age_keyboard(user_id)
-        )
-    elif callback_query.data.startswith("age_"):
-        age_range = callback_query.data.split("_")[1:]
-        user_settings[user_id]["age"] = f"{age_range[0]}-{age_range[1]}"
-        await callback_query.message.edit_text(
-            "Выберите ваш возраст:",
-            reply_markup=get_age_keyboard(user_id)
-        )
-    elif callback_query.data == "style":
-        await callback_query.message.edit_text(
-            "Выберите стиль ответов:",
-            reply_markup=get_style_keyboard(user_id)
-        )
-    elif callback_query.data.startswith("style_"):
-        style = callback_query.data.split("_")[1]
-        user_settings[user_id]["style"] = style
-        await callback_query.message.edit_text(
-            "Выберите стиль ответов:",
-            reply_markup=get_style_keyboard(user_id)
-        )
-    elif callback_query.data == "advice":
-        await callback_query.message.edit_text(
-            "Хотите ли вы получать советы?",
-            reply_markup=get_advice_keyboard(user_id)
-        )
-    elif callback_query.data.startswith("advice_"):
-        advice = callback_query.data.split("_")[1] == "yes"
-        user_settings[user_id]["advice"] = advice
-        await callback_query.message.edit_text(
-            "Хотите ли вы получать советы?",
-            reply_markup=get_advice_keyboard(user_id)
-        )
-    elif callback_query.data == "bot_gender":
-        await callback_query.message.edit_text(
-            "Выберите пол бота:",
-            reply_markup=get_bot_gender_keyboard(user_id)
-        )
-    elif callback_query.data.startswith("bot_gender_"):
-        bot_gender = callback_query.data.split("_")[2]
-        user_settings[user_id]["bot_gender"] = bot_gender
-        db.update_user_setting(user_id, "bot_gender", bot_gender)
-        await callback_query.message.edit_text(
-            "Выберите пол бота:",
-            reply_markup=get_bot_gender_keyboard(user_id)
-        )
-    elif callback_query.data == "user_gender":
-        await callback_query.message.edit_text(
-            "Укажите ваш пол:",
-            reply_markup=get_user_gender_keyboard(user_id)
-        )
-    elif callback_query.data.startswith("user_gender_"):
-        user_gender = callback_query.data.split("_")[2]
-        user_settings[user_id]["user_gender"] = user_gender
-        db.update_user_setting(user_id, "user_gender", user_gender)
-        await callback_query.message.edit_text(
-            "Укажите ваш пол:",
-            reply_markup=get_user_gender_keyboard(user_id)
-        )
-    elif callback_query.data == "back_to_settings":
-        await callback_query.message.edit_text(
-            "⚙️ Настройки",
-            reply_markup=get_settings_keyboard()
-        )
-    elif callback_query.data == "back_to_main":
-        await callback_query.message.delete()
-        await callback_query.message.answer(
-            "Настройки сохранены",
-            reply_markup=get_main_keyboard()
-        )
-    elif callback_query.data == "admin_create_key":
-        if user_id in ADMIN_IDS:
-            new_key = sub_db.create_activation_key()
-            await callback_query.message.answer(f"🔑 Новый ключ активации: `{new_key}`", parse_mode="Markdown")
-        else:
-            await callback_query.answer("У вас нет доступа к этой функции.")
-    elif callback_query.data == "admin_delete_key":
-        if user_id in ADMIN_IDS:
-            admin_states[user_id] = "waiting_for_key_to_delete"
-            await callback_query.message.answer("Введите ключ, который хотите удалить:")
-        else:
-            await callback_query.answer("У вас нет доступа к этой функции.")
+def extract_answer(full_response):
+    parts = full_response.split("Ассистент:", 1)
+    return parts[-1].strip() if len(parts) > 1 else full_response.strip()
+
+MARKDOWN_ESCAPES = str.maketrans({char: "\\" + char for char in "*_[`"})
+
+def escape_markdown(text):
+    return text.translate(MARKDOWN_ESCAPES)
+
+index_tasks = set()
+
+def index_done(task):
+    index_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Error indexing message: {task.exception()}")
+
+async def store_message(user_id, text, is_bot):
+    """Save a message; with retrieval on, also embed it in the background."""
+    await db.add_message(user_id, text, is_bot=is_bot)
+    if vector_index:
+        task = asyncio.create_task(vector_index.add(user_id, text, is_bot))
+        index_tasks.add(task)
+        task.add_done_callback(index_done)
+
+async def find_relevant_messages(user_id, query):
+    try:
+        return await vector_index.search(user_id, query, k=RETRIEVAL_TOP_K, skip_recent=HISTORY_LIMIT)
+    except Exception as e:
+        logger.error(f"Error searching history: {e}")
+        return []
+
+async def stream_answer(message: types.Message, payloads):
+    """Stream the model's answer into a reply; returns it once the model is done."""
+    reply = StreamingReply(
+        message,
+        render=lambda text: escape_markdown(extract_answer(text)),
+        min_interval=STREAM_EDIT_INTERVAL
+    )
+    async for chunk in llm_router.stream(payloads):
+        await reply.feed(chunk)
+    return reply
 
 @dp.message()
-async def handle_message(message: types.Message):
+async def handle_message(message: types.Message, merged_messages: list = None):
     user_id = message.from_user.id
 
-    if user_id in ADMIN_IDS and admin_states.get(user_id) == "waiting_for_key_to_delete":
+    # Stickers, photos and the like have no text to store or answer.
+    if not message.text:
+        return
+
+    if user_id in ADMIN_IDS and await state_store.get(f"admin_state:{user_id}") == "waiting_for_key_to_delete":
         key_to_delete = message.text.strip()
-        if sub_db.delete_activation_key(key_to_delete):
+        if await sub_db.delete_activation_key(key_to_delete):
             await message.answer(f"Ключ `{key_to_delete}` успешно удален.", parse_mode="Markdown")
         else:
             await message.answer(f"Не удалось удалить ключ `{key_to_delete}`. Возможно, его не существует или он уже использован.", parse_mode="Markdown")
-        admin_states.pop(user_id, None) 
+        await state_store.delete(f"admin_state:{user_id}")
         return
 
     if message.text == "❓ Помощь":
@@ -351,8 +652,11 @@ async def handle_message(message: types.Message):
         return
     elif message.text == "🎁 Попробовать бесплатно":
         user_id = message.from_user.id
-        if sub_db.activate_trial(user_id):
-            days_left = sub_db.get_trial_days_left(user_id)
+        trial_expires_at = await sub_db.activate_trial(user_id)
+        if trial_expires_at:
+            if trial_notifier:
+                trial_notifier.track(user_id, trial_expires_at)
+            days_left = await sub_db.get_trial_days_left(user_id)
             await message.answer(
                 f"🎉 Поздравляем! Вам активирован бесплатный период на {days_left} дней!",
                 reply_markup=get_main_keyboard()
@@ -368,149 +672,129 @@ async def handle_message(message: types.Message):
         return
     elif message.text and message.text.startswith("/activate "):
         activation_key = message.text.split(" ", 1)[1].strip()
-        if sub_db.activate_premium(user_id, activation_key):
+        if await sub_db.activate_premium(user_id, activation_key):
             await message.answer("✅ Ваш премиум-доступ успешно активирован!", reply_markup=get_main_keyboard())
         else:
             await message.answer("❌ Неверный ключ активации или он уже использован.", reply_markup=get_main_keyboard())
         return
 
     try:
-        if not sub_db.check_subscription(user_id):
-            await message.answer(
-                "❌ У вас нет активной подписки. Активируйте бесплатный период или приобретите премиум-подписку.",
-                reply_markup=get_main_keyboard()
-            )
-            return
-
-        if user_id not in user_settings:
-            user_settings[user_id] = {
-                "age": None,
-                "style": "short",
-                "advice": False,
-                "bot_gender": None,
-                "user_gender": None
-            }
-        
-        db_settings = db.get_user_settings(user_id)
-        if db_settings:
-            user_settings[user_id]["bot_gender"] = db_settings[0]
-            user_settings[user_id]["user_gender"] = db_settings[1]
-
-        db.add_message(user_id, message.text, is_bot=False)
-        await bot.send_chat_action(chat_id=message.chat.id, action="typing")
-        
-        chat_history = db.get_chat_history(user_id)
-        
-        prompt = ""
-        if SYSTEM_PROMPT:
-            prompt += f"{SYSTEM_PROMPT}\n\n"
-            
-        settings = user_settings[user_id]
-        prompt += f"О пользователе:\n"
-        if settings["age"]:
-            prompt += f"Возраст: {settings['age']}\n"
-        if settings["style"]:
-            prompt += f"Он хочет чтобы ты отвечал: {'Кратко' if settings['style'] == 'short' else 'Развёрнуто'}\n"
-        if settings["advice"] is not None:
-            prompt += f"Хочет ли он чтобы ты давал советы: {'Да' if settings['advice'] else 'Нет'}\n"
-            
-        if settings["bot_gender"]:
-            bot_gender_ru = "женский" if settings["bot_gender"] == "female" else \
-                            "мужской" if settings["bot_gender"] == "male" else \
-                            "нейтральный"
-            prompt += f"Пол бота: {bot_gender_ru}\n"
-            
-        if settings["user_gender"]:
-            user_gender_ru = "женский" if settings["user_gender"] == "female" else \
-                             "мужской" if settings["user_gender"] == "male" else \
-                             "нейтральный"
-            prompt += f"Пол пользователя: {user_gender_ru}\n"
-
-        if settings["bot_gender"] == "neutral" or settings["user_gender"] == "neutral":
-            prompt += "Составляй ответы так, чтобы не был понятен твой пол и пол собеседника.\n"
-
-        prompt += "\n"
-
-        for msg_text, is_bot, _ in chat_history[-5:]:
-            role = "Ассистент" if is_bot else "Пользователь"
-            prompt += f"{role}: {msg_text}\n"
-        
-        prompt += f"Пользователь: {message.text}\nАссистент:"
-        
-        try:
-            response = requests.post(
-                f"{LOCAL_API_URL}/v1/completions",
-                json={
-                    "model": "google/gemma-3-12b",
-                    "prompt": prompt,
-                    "temperature": 0.7,
-                    "max_tokens": 1000,
-                    "top_p": 0.9,
-                    "frequency_penalty": 0.0,
-                    "presence_penalty": 0.0,
-                    "stop": ["Пользователь:", "Система:"]
-                },
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "application/json"
-                },
-                timeout=10
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"Local API returned {response.status_code}")
-                
-        except Exception as e:
-            logging.warning(f"Local API failed, falling back to DeepSeek: {str(e)}")
-            response = requests.post(
-                DEEPSEEK_API_URL,
-                json={
-                    "model": "deepseek-chat",
-                    "messages": [
-                        {"role": "system", "content": SYSTEM_PROMPT if SYSTEM_PROMPT else ""},
-                        {"role": "user", "content": message.text}
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 1000
-                },
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-                }
-            )
-        
-        if response.status_code == 200:
-            response_data = response.json()
-            
-            if "choices" in response_data and len(response_data["choices"]) > 0:
-                if "text" in response_data["choices"][0]:
-                    full_response = response_data["choices"][0]["text"].strip()
-                else:
-                    full_response = response_data["choices"][0]["message"]["content"].strip()
-                
-                if full_response:
-                    parts = full_response.split("Ассистент:", 1)
-                    ai_response = parts[-1].strip() if len(parts) > 1 else full_response
-                    logging.info(f"Финальный ответ ИИ: {ai_response}")
-                    db.add_message(user_id, ai_response, is_bot=True)
-                    ai_response = ai_response.replace('*', '\\*').replace('_', '\\_').replace('[', '\\[').replace('`', '\\`')
-                    await message.reply(ai_response, parse_mode="Markdown")
-                    return
-                else:
-                    raise Exception("Пустой ответ от модели")
-            else:
-                raise Exception("Нет вариантов ответа")
-        else:
-            raise Exception(f"API вернул код {response.status_code}: {response.text}")
-            
+        await answer_message(message, merged_messages)
+    except Superseded:
+        metrics.inc("superseded_total")
+        logger.info(f"Запрос пользователя {user_id} заменён более новым сообщением")
     except Exception as e:
-        logging.error(f"Детали ошибки: {str(e)}")
+        metrics.inc("errors_total")
+        logger.error(f"Детали ошибки: {str(e)}", extra={"user_id": user_id})
         error_msg = "*Произошла ошибка. Пожалуйста, попробуйте позже.* ❌"
-        db.add_message(message.from_user.id, error_msg, is_bot=True)
+        await store_message(message.from_user.id, error_msg, is_bot=True)
         await message.reply(error_msg, parse_mode="Markdown")
 
+async def answer_message(message: types.Message, merged_messages: list = None):
+    started = time.perf_counter()
+    user_id = message.from_user.id
+    with metrics.timer("subscription"):
+        has_subscription = sub_cache.check(user_id)
+        if has_subscription is None:
+            has_subscription = await sub_db.check_subscription(user_id)
+    if not has_subscription:
+        await message.answer(
+            "❌ У вас нет активной подписки. Активируйте бесплатный период или приобретите премиум-подписку.",
+            reply_markup=get_main_keyboard()
+        )
+        return
+
+    # "total" only covers turns that go to the model.
+    with metrics.timer("total", start=started, ignore=(Superseded,)):
+        await answer_with_model(message, merged_messages)
+
+async def answer_with_model(message: types.Message, merged_messages: list = None):
+    user_id = message.from_user.id
+    # Messages merged by flood control are stored one by one and answered together.
+    texts = [merged.text for merged in merged_messages] if merged_messages else [message.text]
+    user_text = "\n".join(texts)
+    with metrics.timer("settings"):
+        settings = await settings_store.get(user_id)
+    with metrics.timer("history"):
+        chat_history = await db.get_chat_history(user_id, limit=HISTORY_LIMIT)
+        summary = await db.get_summary(user_id) if summarizer else None
+    recalled = None
+    if vector_index:
+        with metrics.timer("retrieval"):
+            recalled = await find_relevant_messages(user_id, user_text)
+    with metrics.timer("store"):
+        for text in texts:
+            await store_message(user_id, text, is_bot=False)
+    await bot.send_chat_action(chat_id=message.chat.id, action="typing")
+
+    with metrics.timer("prompt"):
+        prompt = prompt_builder.build(
+            settings, chat_history, user_text, summary[0] if summary else None, recalled
+        )
+        payloads = build_payloads(prompt)
+
+    # The scheduler slot covers only the generation; storing the answer and
+    # the final send, which may wait on Telegram's limits, happen after it.
+    reply = None
+    if STREAM_RESPONSES:
+        with metrics.timer("stream", ignore=(Superseded,)):
+            reply = await llm_scheduler.run(user_id, lambda: stream_answer(message, payloads))
+        ai_response = extract_answer(reply.text)
+        if not ai_response:
+            raise Exception("Пустой ответ от модели")
+    else:
+        with metrics.timer("llm", ignore=(Superseded,)):
+            full_response = await llm_scheduler.run(user_id, lambda: llm_router.complete(payloads))
+        ai_response = extract_answer(full_response)
+    logger.info("Финальный ответ ИИ", extra={"user_id": user_id, "content": ai_response})
+    with metrics.timer("store"):
+        await store_message(user_id, ai_response, is_bot=True)
+    if summarizer:
+        summarizer.note_messages(user_id, len(texts) + 1)
+    with metrics.timer("send"):
+        if reply is not None:
+            await reply.finish(escape_markdown(ai_response))
+        else:
+            await message.reply(escape_markdown(ai_response), parse_mode="Markdown")
+
+async def on_startup():
+    global metrics_runner
+    if METRICS_PORT:
+        metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+    await llm.start()
+    if summarizer:
+        await summarizer.start()
+    if trial_notifier:
+        await trial_notifier.start()
+    await scheduler.start()
+
+async def on_shutdown():
+    await scheduler.close()
+    if summarizer:
+        await summarizer.close()
+    await llm.close()
+    await sub_db.close()
+    if index_tasks:
+        await asyncio.gather(*index_tasks, return_exceptions=True)
+    if vector_index:
+        await vector_index.close()
+    await db.close()
+    await state_store.close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
 async def main():
-    await dp.start_polling(bot)
+    if WEBHOOK_URL:
+        await webhook.serve(
+            dp, bot, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT,
+            workers=WEBHOOK_WORKERS, secret=WEBHOOK_SECRET
+        )
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+
+class CompletionBatcher:
+    """Micro-batches prompts for an OpenAI-compatible /v1/completions backend.
+
+    Prompts arriving within `window` seconds (or until `max_batch` are
+    collected) are sent as one request with a list `prompt`, and each
+    caller gets back its own choice, matched by `index`. Only payloads with
+    identical sampling parameters are batched together.
+    """
+
+    def __init__(self, client, backend="local", window=0.02, max_batch=8):
+        self.client = client
+        self.backend = backend
+        self.window = window
+        self.max_batch = max_batch
+        self._batches = {}
+        self._tasks = set()
+
+    async def complete(self, payload: dict) -> dict:
+        params = {key: value for key, value in payload.items() if key != "prompt"}
+        key = json.dumps(params, sort_keys=True)
+        future = asyncio.get_running_loop().create_future()
+
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = {"params": params, "prompts": [], "futures": []}
+            batch["timer"] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+        batch["prompts"].append(payload["prompt"])
+        batch["futures"].append(future)
+        if len(batch["prompts"]) >= self.max_batch:
+            self._flush(key)
+
+        return {"choices": [await future]}
+
+    def _flush(self, key):
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        batch["timer"].cancel()
+        task = asyncio.ensure_future(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        futures = batch["futures"]
+        try:
+            response = await self.client.post_json(
+                self.backend, {**batch["params"], "prompt": batch["prompts"]}
+            )
+            choices = {choice.get("index", i): choice for i, choice in enumerate(response.get("choices", []))}
+            for index, future in enumerate(futures):
+                if future.done():
+                    continue
+                if index in choices:
+                    future.set_result(choices[index])
+                else:
+                    future.set_exception(Exception("Нет вариантов ответа"))
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
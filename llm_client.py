@@ -0,0 +1,105 @@
+import json
+
+import aiohttp
+
+
+class LLMError(Exception):
+    pass
+
+
+class LLMBackend:
+    """Connection settings for one OpenAI-compatible endpoint."""
+
+    def __init__(self, name, url, headers=None, connect_timeout=3.0, read_timeout=60.0,
+                 pool_size=100, keepalive_timeout=30.0):
+        self.name = name
+        self.url = url
+        self.headers = headers or {}
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+
+
+class LLMClient:
+    """Shared aiohttp client with one keep-alive pool per backend.
+
+    Created once at bot startup (`start`) and closed on shutdown (`close`),
+    so every handler reuses warm connections instead of blocking the loop.
+    """
+
+    def __init__(self, backends):
+        self.backends = {backend.name: backend for backend in backends}
+        self._sessions = {}
+
+    async def start(self):
+        for name, backend in self.backends.items():
+            if name in self._sessions:
+                continue
+            connector = aiohttp.TCPConnector(
+                limit=backend.pool_size,
+                keepalive_timeout=backend.keepalive_timeout
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                connect=backend.connect_timeout,
+                sock_read=backend.read_timeout
+            )
+            self._sessions[name] = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                headers={
+                    "Content-Type": "application/json",
+                    "Accept": "application/json",
+                    **backend.headers
+                }
+            )
+
+    async def close(self):
+        sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            await session.close()
+
+    def session(self, name):
+        if name not in self._sessions:
+            raise LLMError(f"Backend {name} is not started")
+        return self._sessions[name]
+
+    async def post_json(self, name, payload: dict) -> dict:
+        backend = self.backends[name]
+        async with self.session(name).post(backend.url, json=payload) as response:
+            if response.status != 200:
+                body = await response.text()
+                raise LLMError(f"{name} returned {response.status}: {body}")
+            return await response.json(content_type=None)
+
+    async def stream(self, name, payload: dict):
+        """Yield text deltas from an SSE (`stream: true`) completion.
+
+        Works for both completion chunks (`choices[0].text`) and chat chunks
+        (`choices[0].delta.content`).
+        """
+        backend = self.backends[name]
+        async with self.session(name).post(
+            backend.url,
+            json={**payload, "stream": True},
+            headers={"Accept": "text/event-stream"}
+        ) as response:
+            if response.status != 200:
+                body = await response.text()
+                raise LLMError(f"{name} returned {response.status}: {body}")
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                choices = json.loads(data).get("choices")
+                if not choices:
+                    continue
+                text = choices[0].get("text")
+                if text is None:
+                    text = (choices[0].get("delta") or {}).get("content")
+                if text:
+                    yield text
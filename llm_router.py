@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from llm_client import LLMError
+
+logger = logging.getLogger(__name__)
+
+
+class BackendHealth:
+    """Rolling latency/error window and circuit breaker for one backend.
+
+    The circuit opens after `max_consecutive_failures` failures in a row or
+    when the error rate over the window reaches `error_rate_threshold`.
+    While open the backend is skipped; after `cooldown` seconds a single
+    probe request is let through and its outcome closes or re-opens it.
+    """
+
+    def __init__(self, window=100, error_rate_threshold=0.5, min_samples=10,
+                 max_consecutive_failures=3, cooldown=30.0):
+        self.samples = deque(maxlen=window)
+        self.error_rate_threshold = error_rate_threshold
+        self.min_samples = min_samples
+        self.max_consecutive_failures = max_consecutive_failures
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.open_until > 0
+
+    def available(self, now=None) -> bool:
+        if not self.is_open:
+            return True
+        if now is None:
+            now = time.monotonic()
+        return now >= self.open_until and not self.probing
+
+    def begin(self):
+        """Mark a request as started; on an open circuit it is the probe."""
+        if self.is_open:
+            self.probing = True
+
+    def abandon(self):
+        """The request was cancelled before it produced an outcome."""
+        self.probing = False
+
+    def record(self, latency: float, ok: bool):
+        self.samples.append((latency, ok))
+        if ok:
+            self.consecutive_failures = 0
+            if self.is_open:
+                self.open_until = 0.0
+                self.probing = False
+                self.samples.clear()
+            return
+        self.consecutive_failures += 1
+        if (self.probing
+                or self.consecutive_failures >= self.max_consecutive_failures
+                or (len(self.samples) >= self.min_samples and self.error_rate >= self.error_rate_threshold)):
+            self.open_until = time.monotonic() + self.cooldown
+            self.probing = False
+
+    @property
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+
+    def latency_quantile(self, q: float):
+        latencies = sorted(latency for latency, ok in self.samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+
+
+class LLMRoute:
+    """One backend as seen by the router.
+
+    `kind` selects which payload shape the backend takes: "completion"
+    (prompt string) or "chat" (messages list).
+    """
+
+    def __init__(self, name, kind, model, health=None, batcher=None):
+        self.name = name
+        self.kind = kind
+        self.model = model
+        self.health = health or BackendHealth()
+        self.batcher = batcher
+
+    async def request(self, client, payloads: dict) -> str:
+        payload = {**payloads[self.kind], "model": self.model}
+        if self.batcher is not None:
+            response_data = await self.batcher.complete(payload)
+        else:
+            response_data = await client.post_json(self.name, payload)
+
+        choices = response_data.get("choices")
+        if not choices:
+            raise LLMError("Нет вариантов ответа")
+        if "text" in choices[0]:
+            text = choices[0]["text"]
+        else:
+            text = choices[0]["message"]["content"]
+        if not text or not text.strip():
+            raise LLMError("Пустой ответ от модели")
+        return text.strip()
+
+
+class LLMRouter:
+    """Sends each request to the healthiest backend, in configured order.
+
+    Backends with an open circuit are skipped; a failure moves on to the
+    next backend immediately. With `hedge` enabled, a duplicate request is
+    sent to the next backend once the current one runs past its p95
+    latency, and whichever answers first wins. With `metrics`, each backend
+    call is timed and every answer not from the first backend counts as a
+    fallback.
+    """
+
+    def __init__(self, client, routes, hedge=False, hedge_min_samples=20, metrics=None):
+        self.client = client
+        self.routes = routes
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.metrics = metrics
+        self.hedged = 0
+
+    def candidates(self) -> list:
+        now = time.monotonic()
+        routes = [route for route in self.routes if route.health.available(now)]
+        return routes or list(self.routes)
+
+    async def _call(self, route, payloads):
+        start = time.monotonic()
+        route.health.begin()
+        try:
+            text = await route.request(self.client, payloads)
+        except asyncio.CancelledError:
+            route.health.abandon()
+            raise
+        except Exception:
+            self._record(route, time.monotonic() - start, False)
+            raise
+        self._record(route, time.monotonic() - start, True)
+        return text
+
+    def _record(self, route, latency, ok):
+        route.health.record(latency, ok)
+        if self.metrics is not None:
+            self.metrics.observe("llm_backend_seconds", latency, backend=route.name)
+            self.metrics.inc("llm_requests_total", backend=route.name, result="ok" if ok else "error")
+
+    def _answered(self, route):
+        if self.metrics is not None:
+            self.metrics.inc("llm_answers_total", backend=route.name)
+            if route is not self.routes[0]:
+                self.metrics.inc("llm_fallbacks_total")
+
+    def _hedge_delay(self, route):
+        if not self.hedge or len(route.health.samples) < self.hedge_min_samples:
+            return None
+        return route.health.latency_quantile(0.95)
+
+    async def complete(self, payloads: dict) -> str:
+        routes = self.candidates()
+        pending = {}
+        errors = []
+        next_index = 0
+
+        def launch():
+            nonlocal next_index
+            route = routes[next_index]
+            next_index += 1
+            pending[asyncio.ensure_future(self._call(route, payloads))] = route
+            return route
+
+        primary = launch()
+        try:
+            while pending:
+                timeout = None
+                if len(pending) == 1 and next_index < len(routes):
+                    timeout = self._hedge_delay(primary)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedged += 1
+                    logger.info(f"{primary.name} is slower than its p95, hedging")
+                    primary = launch()
+                    continue
+                for task in done:
+                    route = pending.pop(task)
+                    try:
+                        text = task.result()
+                    except Exception as e:
+                        errors.append(f"{route.name}: {e}")
+                        logger.warning(f"{route.name} failed: {e}")
+                        continue
+                    self._answered(route)
+                    return text
+                if not pending and next_index < len(routes):
+                    primary = launch()
+            raise LLMError("; ".join(errors))
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, payloads: dict):
+        """Yield chunks from the first backend that starts streaming."""
+        errors = []
+        for route in self.candidates():
+            payload = {**payloads[route.kind], "model": route.model}
+            start = time.monotonic()
+            started = False
+            recorded = False
+            route.health.begin()
+            try:
+                async for chunk in self.client.stream(route.name, payload):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                recorded = True
+                self._record(route, time.monotonic() - start, False)
+                if started:
+                    raise
+                errors.append(f"{route.name}: {e}")
+                logger.warning(f"{route.name} failed: {e}")
+                continue
+            else:
+                recorded = True
+                self._record(route, time.monotonic() - start, True)
+                self._answered(route)
+                return
+            finally:
+                # Cancelled, or closed by a caller that stopped reading:
+                # release the probe slot so the circuit can be probed again.
+                if not recorded:
+                    route.health.abandon()
+        raise LLMError("; ".join(errors))
+
+    def stats(self) -> list:
+        return [
+            {
+                "name": route.name,
+                "open": route.health.is_open,
+                "error_rate": route.health.error_rate,
+                "p95": route.health.latency_quantile(0.95),
+            }
+            for route in self.routes
+        ]
@@ -0,0 +1,119 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+
+class Superseded(Exception):
+    """The queued request was replaced by a newer one from the same user."""
+
+
+class LLMScheduler:
+    """Caps concurrent LLM generations and queues the rest fairly per user.
+
+    Each user holds at most one place in the queue: a newer request takes
+    over the older one's place and the older caller gets `Superseded`.
+    Places are served first-come first-served, so a user sending many
+    messages cannot push anybody else back. Background work submitted via
+    `run_background` only gets a slot when no user request is waiting.
+    """
+
+    def __init__(self, max_concurrency=4):
+        self.max_concurrency = max_concurrency
+        self.running = 0
+        self._queue = OrderedDict()
+        self._background = deque()
+        self.granted = 0
+        self.superseded = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    async def run(self, user_id: int, factory):
+        """Run `factory()` once a slot is free; raise Superseded if replaced."""
+        await self._acquire(user_id)
+        try:
+            return await factory()
+        finally:
+            self._release()
+
+    async def _acquire(self, user_id):
+        enqueued_at = time.monotonic()
+        if self.running < self.max_concurrency and not self._queue:
+            self._grant(enqueued_at)
+            return
+
+        previous = self._queue.get(user_id)
+        if previous is not None:
+            previous[0].set_exception(Superseded())
+            self.superseded += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._queue[user_id] = (waiter, enqueued_at)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if self._queue.get(user_id, (None,))[0] is waiter:
+                del self._queue[user_id]
+            elif waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self._release()
+            raise
+
+    async def run_background(self, factory):
+        """Run low-priority work (e.g. summaries) behind all user requests.
+
+        Background waits are not counted in the user-facing wait statistics.
+        """
+        if self.running < self.max_concurrency and not self._queue and not self._background:
+            self.running += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._background.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if not waiter.done() or waiter.cancelled():
+                    if waiter in self._background:
+                        self._background.remove(waiter)
+                else:
+                    self._release()
+                raise
+        try:
+            return await factory()
+        finally:
+            self._release()
+
+    def _grant(self, enqueued_at):
+        wait = time.monotonic() - enqueued_at
+        self.running += 1
+        self.granted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def _release(self):
+        self.running -= 1
+        while self._queue and self.running < self.max_concurrency:
+            _, (waiter, enqueued_at) = self._queue.popitem(last=False)
+            if waiter.done():
+                continue
+            self._grant(enqueued_at)
+            waiter.set_result(None)
+        while self._background and not self._queue and self.running < self.max_concurrency:
+            waiter = self._background.popleft()
+            if waiter.done():
+                continue
+            self.running += 1
+            waiter.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "queued": self.queue_depth,
+            "background": len(self._background),
+            "granted": self.granted,
+            "superseded": self.superseded,
+            "avg_wait": self.total_wait / self.granted if self.granted else 0.0,
+            "max_wait": self.max_wait,
+        }
@@ -0,0 +1,141 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has; anything else on a record came from `extra`.
+STANDARD_ATTRS = frozenset(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "taskName"}
+
+# `extra` fields carrying user or model text; replaced by their length unless logged in full.
+CONTENT_FIELDS = frozenset(("content", "prompt", "response", "text"))
+
+
+def parse_categories(spec: str) -> dict:
+    """"aiogram.event=WARNING,llm_router=0.5" -> {"aiogram.event": "WARNING", "llm_router": "0.5"}."""
+    categories = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        name, _, value = item.partition("=")
+        categories[name.strip()] = value.strip()
+    return categories
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, `extra` fields and exc."""
+
+    def __init__(self, redact=True):
+        super().__init__()
+        self.redact = redact
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key in STANDARD_ATTRS:
+                continue
+            if self.redact and key in CONTENT_FIELDS and value is not None:
+                value = f"<redacted, {len(str(value))} chars>"
+            entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records below WARNING from chosen loggers.
+
+    `rates` maps a logger name to the share to keep; it also covers the
+    logger's children, the longest matching name winning.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self._resolved = {}
+
+    def _rate(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate = 1.0
+            for prefix in sorted(self.rates, key=len, reverse=True):
+                if name == prefix or name.startswith(prefix + "."):
+                    rate = self.rates[prefix]
+                    break
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate >= 1.0:
+            return True
+        if random.random() >= rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread as they are, dropping them when the queue is full.
+
+    Formatting happens on the writer thread, so a log call in a handler
+    costs a filter check and a queue put.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _stop(listener):
+    # QueueListener.stop fails if it was already stopped (before Python 3.12).
+    if listener._thread is not None:
+        listener.stop()
+
+
+def setup_logging(level="INFO", levels=None, sample=None, redact=True, stream=None, queue_size=10_000):
+    """Route all logging through a bounded queue to a JSON writer thread.
+
+    `levels` maps logger names to level names, `sample` maps logger names
+    to the share of their sub-WARNING records to keep, and `redact` hides
+    CONTENT_FIELDS. Returns the started QueueListener; it is stopped, and
+    the queue drained, at interpreter exit.
+    """
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(JsonFormatter(redact=redact))
+    log_queue = queue.Queue(queue_size)
+    handler = NonBlockingQueueHandler(log_queue)
+    if sample:
+        handler.addFilter(SamplingFilter({name: float(rate) for name, rate in sample.items()}))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, category_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(category_level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, writer, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop, listener)
+    return listener
@@ -0,0 +1,109 @@
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MessageJournal:
+    """Write-behind buffer for chat messages.
+
+    `append` only queues a row; a background thread writes the queue with a
+    single `executemany` transaction every `flush_interval` seconds, or as
+    soon as `max_rows` rows are waiting. Rows stay visible through `pending`
+    until they are committed, and `close` flushes whatever is left.
+
+    A batch that breaks a constraint is retried row by row and only the
+    failing rows are dropped. Other errors keep the batch for the next
+    flush, up to `max_pending` buffered rows; past that the oldest go.
+    """
+
+    def __init__(self, conn, flush_interval=0.05, max_rows=256, max_pending=100_000):
+        self.conn = conn
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.lock = threading.RLock()
+        self._rows = []
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="message-journal", daemon=True)
+        self._thread.start()
+
+    def append(self, user_id: int, message_text: str, is_bot: bool):
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        with self.lock:
+            self._rows.append((user_id, message_text, is_bot, timestamp))
+            if len(self._rows) >= self.max_rows:
+                self._wakeup.set()
+
+    def pending(self, user_id: int) -> list:
+        """Unflushed messages of one user, oldest first, as history rows."""
+        with self.lock:
+            return [(text, is_bot, timestamp) for uid, text, is_bot, timestamp in self._rows if uid == user_id]
+
+    def discard(self, user_id: int):
+        with self.lock:
+            self._rows = [row for row in self._rows if row[0] != user_id]
+
+    def flush(self):
+        # The lock is held until the rows are committed, so readers that take
+        # it see each row either in the buffer or in the table, never neither.
+        with self.lock:
+            if not self._rows:
+                return
+            rows, self._rows = self._rows, []
+            try:
+                try:
+                    self._write(rows)
+                except sqlite3.IntegrityError as e:
+                    logger.error(f"Error flushing messages, retrying one by one: {e}")
+                    self._write_each(rows)
+            except Exception as e:
+                self._rows = rows + self._rows
+                logger.error(f"Error flushing messages: {e}")
+                overflow = len(self._rows) - self.max_pending
+                if overflow > 0:
+                    del self._rows[:overflow]
+                    self.dropped += overflow
+                    logger.error(f"Message journal is full, dropped {overflow} oldest messages")
+
+    def _write(self, rows):
+        with self.conn.transaction() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO users (user_id) VALUES (?)',
+                [(user_id,) for user_id in {row[0] for row in rows}]
+            )
+            conn.executemany('''
+                INSERT INTO messages (user_id, message_text, is_bot, timestamp)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+
+    def _write_each(self, rows):
+        # A failed statement is undone on its own, so the good rows still
+        # commit together.
+        with self.conn.transaction() as conn:
+            for row in rows:
+                try:
+                    conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (row[0],))
+                    conn.execute('''
+                        INSERT INTO messages (user_id, message_text, is_bot, timestamp)
+                        VALUES (?, ?, ?, ?)
+                    ''', row)
+                except sqlite3.IntegrityError as e:
+                    self.dropped += 1
+                    logger.error(f"Dropped message of user {row[0]}: {e}")
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
@@ -0,0 +1,141 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# Upper bounds in seconds, from a SQLite read to a slow model answer.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        """Upper bound of the bucket holding the q-quantile (inf past the last bucket)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    """Counters and fixed-bucket histograms, exported in Prometheus text format.
+
+    Recording is a dict lookup and a bisect, so the timers can wrap every
+    stage of every update. Names get `prefix`; labels are keyword arguments.
+    """
+
+    def __init__(self, prefix="gbot", buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def inc(self, name: str, amount=1, **labels):
+        key = _key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, stage: str, start=None, ignore=(), **labels):
+        """Time the block into `stage_seconds`; exceptions also count in `stage_errors_total`.
+
+        `start` is a perf_counter() value to time from instead of entering
+        the block; exceptions of the `ignore` types are not errors.
+        """
+        if start is None:
+            start = time.perf_counter()
+        try:
+            yield
+        except ignore:
+            raise
+        except Exception:
+            self.inc("stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+    def histograms(self, name: str) -> list:
+        """[(labels dict, Histogram)] for one metric name."""
+        return [(dict(labels), histogram) for (key, labels), histogram in self._histograms.items() if key == name]
+
+    def counter(self, name: str, **labels):
+        if labels:
+            return self._counters.get(_key(name, labels), 0)
+        return sum(value for (key, _), value in self._counters.items() if key == name)
+
+    def render(self) -> str:
+        lines = []
+        counters = {}
+        for (name, labels), value in self._counters.items():
+            counters.setdefault(name, []).append((labels, value))
+        for name, series in sorted(counters.items()):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full_name} counter")
+            for labels, value in series:
+                lines.append(f"{full_name}{_format_labels(labels)} {value}")
+
+        histograms = {}
+        for (name, labels), histogram in self._histograms.items():
+            histograms.setdefault(name, []).append((labels, histogram))
+        for name, series in sorted(histograms.items()):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full_name} histogram")
+            for labels, histogram in series:
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def serve(self, host: str, port: int) -> web.AppRunner:
+        """Serve GET /metrics on host:port; clean up the returned runner to stop."""
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
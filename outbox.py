@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendChatAction, SendMessage
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now) -> float:
+        """Seconds until a token is available (0 if one is now)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+
+def split_text(text: str, limit=TELEGRAM_MESSAGE_LIMIT) -> list:
+    """Split at the last newline (else space) before `limit`, never after a lone backslash."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", limit // 2, limit)
+        if cut == -1:
+            cut = text.rfind(" ", limit // 2, limit)
+        if cut == -1:
+            cut = limit
+        head = text[:cut]
+        if (len(head) - len(head.rstrip("\\"))) % 2:
+            cut -= 1
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
+
+
+class Outbox(BaseRequestMiddleware):
+    """Bot session middleware that queues every send and edit.
+
+    Calls addressed to a chat wait for a token from the global bucket and
+    from that chat's bucket (groups get a slower one), run in arrival order
+    per chat, and are retried after Telegram's `retry_after` on 429. Text
+    longer than one Telegram message is sent as several messages, with the
+    reply markup on the last one. Time spent queued is kept for `stats`;
+    with `metrics`, every Bot API call is also timed by method.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1.0, chat_burst=3, group_rate=20 / 60,
+                 max_retries=3, max_chats=10_000, metrics=None):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.metrics = metrics
+        self._chats = OrderedDict()
+        self._locks = {}
+        self._waits = deque(maxlen=1000)
+        self.queued = 0
+        self.sent = 0
+        self.retried = 0
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            bucket = TokenBucket(self.group_rate if is_group else self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _acquire(self, chat_id):
+        while True:
+            now = time.monotonic()
+            bucket = self._bucket(chat_id)
+            wait = max(self.global_bucket.delay(now), bucket.delay(now))
+            if wait <= 0:
+                self.global_bucket.take()
+                bucket.take()
+                return
+            await asyncio.sleep(wait)
+
+    async def _request(self, make_request, bot, method):
+        if self.metrics is None:
+            return await make_request(bot, method)
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            self.metrics.inc("telegram_errors_total", method=method.__api_method__)
+            raise
+        finally:
+            self.metrics.observe("telegram_seconds", time.perf_counter() - start, method=method.__api_method__)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if isinstance(method, SendChatAction):
+            # The typing indicator is cosmetic: never queue it, and a 429 must not fail the reply.
+            try:
+                return await self._request(make_request, bot, method)
+            except TelegramRetryAfter:
+                return False
+        if chat_id is None:
+            return await self._request(make_request, bot, method)
+        if isinstance(method, SendMessage) and len(method.text) > TELEGRAM_MESSAGE_LIMIT:
+            chunks = split_text(method.text)
+            response = None
+            for index, chunk in enumerate(chunks):
+                update = {"text": chunk}
+                if index > 0:
+                    update.update(reply_parameters=None, reply_to_message_id=None)
+                if index < len(chunks) - 1:
+                    update["reply_markup"] = None
+                response = await self(make_request, bot, method.model_copy(update=update))
+            return response
+
+        # [lock, users]: the lock keeps one chat's calls in arrival order and
+        # is dropped once nobody holds or waits for it.
+        entry = self._locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        queued_at = time.monotonic()
+        waiting = True
+        self.queued += 1
+        try:
+            async with entry[0]:
+                for attempt in range(self.max_retries + 1):
+                    await self._acquire(chat_id)
+                    if waiting:
+                        waiting = False
+                        self.queued -= 1
+                        self._waits.append(time.monotonic() - queued_at)
+                    try:
+                        response = await self._request(make_request, bot, method)
+                        self.sent += 1
+                        return response
+                    except TelegramRetryAfter as e:
+                        if attempt == self.max_retries:
+                            raise
+                        self.retried += 1
+                        logger.warning(f"Telegram asked to retry {method.__api_method__} to {chat_id} in {e.retry_after}s")
+                        self._bucket(chat_id).paused_until = time.monotonic() + e.retry_after
+        finally:
+            if waiting:
+                self.queued -= 1
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[chat_id]
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            "queued": self.queued,
+            "sent": self.sent,
+            "retried": self.retried,
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "max_wait": waits[-1] if waits else 0.0,
+        }
@@ -0,0 +1,117 @@
+from functools import lru_cache
+
+GENDERS_RU = {"female": "женский", "male": "мужской"}
+
+
+def approx_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token) used for budgeting."""
+    return len(text) // 4 + 1
+
+
+@lru_cache(maxsize=1024)
+def render_profile(age, style, advice, bot_gender, user_gender) -> str:
+    """Render the "О пользователе" block; there are only a few distinct ones."""
+    profile = "О пользователе:\n"
+    if age:
+        profile += f"Возраст: {age}\n"
+    if style:
+        profile += f"Он хочет чтобы ты отвечал: {'Кратко' if style == 'short' else 'Развёрнуто'}\n"
+    if advice is not None:
+        profile += f"Хочет ли он чтобы ты давал советы: {'Да' if advice else 'Нет'}\n"
+    if bot_gender:
+        profile += f"Пол бота: {GENDERS_RU.get(bot_gender, 'нейтральный')}\n"
+    if user_gender:
+        profile += f"Пол пользователя: {GENDERS_RU.get(user_gender, 'нейтральный')}\n"
+    if bot_gender == "neutral" or user_gender == "neutral":
+        profile += "Составляй ответы так, чтобы не был понятен твой пол и пол собеседника.\n"
+    return profile
+
+
+class Prompt:
+    """One request, rendered either as a completion prompt or chat messages.
+
+    Segments go from most to least shared: the static system prompt, the
+    user's profile and conversation summary, then the recent turns, so
+    consecutive requests keep the longest possible common prefix for the
+    server's KV cache. Recalled snippets change with every message, so they
+    come last, right before the new user message.
+    """
+
+    def __init__(self, system, profile, turns, user_text, summary=None, recalled=None):
+        self.system = system
+        self.profile = profile
+        self.turns = turns
+        self.user_text = user_text
+        self.summary = summary
+        self.recalled = recalled or []
+
+    @property
+    def context(self) -> str:
+        context = self.system + self.profile
+        if self.summary:
+            context += f"\nКраткое содержание прошлых бесед:\n{self.summary}\n"
+        return context
+
+    @property
+    def recalled_text(self) -> str:
+        if not self.recalled:
+            return ""
+        return "Фрагменты прошлых бесед, связанные с темой:\n" + "".join(
+            f"- {'Ассистент' if is_bot else 'Пользователь'}: {text}\n" for is_bot, text in self.recalled
+        )
+
+    def completion(self) -> str:
+        lines = [f"{self.context}\n"]
+        for is_bot, text in self.turns:
+            lines.append(f"{'Ассистент' if is_bot else 'Пользователь'}: {text}\n")
+        if self.recalled:
+            lines.append(f"Система: {self.recalled_text}")
+        lines.append(f"Пользователь: {self.user_text}\nАссистент:")
+        return "".join(lines)
+
+    def chat_messages(self) -> list:
+        messages = [{"role": "system", "content": self.context}]
+        for is_bot, text in self.turns:
+            messages.append({"role": "assistant" if is_bot else "user", "content": text})
+        if self.recalled:
+            messages.append({"role": "system", "content": self.recalled_text})
+        messages.append({"role": "user", "content": self.user_text})
+        return messages
+
+
+class PromptBuilder:
+    def __init__(self, system_prompt=None, history_tokens=1500, count_tokens=approx_tokens):
+        self.system = f"{system_prompt}\n\n" if system_prompt else ""
+        self.history_tokens = history_tokens
+        self.count_tokens = count_tokens
+
+    def build(self, settings, chat_history: list, user_text: str, summary=None, recalled=None) -> Prompt:
+        """`settings` is a `UserSettings` record; `chat_history` holds
+        (text, is_bot, timestamp) rows, oldest first; `recalled` holds
+        (text, is_bot, score) rows from the vector index.
+        """
+        profile = render_profile(
+            settings.age, settings.style, settings.advice,
+            settings.bot_gender, settings.user_gender
+        )
+        budget = self.history_tokens - self.count_tokens(user_text)
+        turns = self.recent_turns(chat_history, budget)
+        budget -= sum(self.count_tokens(text) for _, text in turns)
+        recalled_turns = []
+        for text, is_bot, _ in recalled or ():
+            budget -= self.count_tokens(text)
+            if budget < 0:
+                break
+            recalled_turns.append((is_bot, text))
+        return Prompt(self.system, profile, turns, user_text, summary, recalled_turns)
+
+    def recent_turns(self, chat_history: list, budget: int) -> list:
+        """The newest (is_bot, text) turns of `chat_history` that fit in `budget` tokens, oldest first."""
+        turns = []
+        for text, is_bot, _ in reversed(chat_history):
+            budget -= self.count_tokens(text)
+            if budget < 0:
+                break
+            turns.append((is_bot, text))
+        turns.reverse()
+        return turns
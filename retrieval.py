@@ -0,0 +1,142 @@
+import json
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    """CPU-only default embedder: hashed unigrams and bigrams, sublinear TF.
+
+    Uses crc32 rather than `hash()` so vectors stay valid across restarts.
+    Any callable mapping a list of texts to an (n, dim) float32 array of
+    L2-normalized rows can be used instead.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def __call__(self, texts) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = TOKEN_RE.findall(text.lower())
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            counts = {}
+            for feature in features:
+                h = zlib.crc32(feature.encode("utf-8"))
+                index = h % self.dim
+                counts[index] = counts.get(index, 0.0) + (1.0 if h & 0x80000000 else -1.0)
+            for index, count in counts.items():
+                vectors[row, index] = np.sign(count) * np.log1p(abs(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class UserVectors:
+    """Growable in-memory copy of one user's vectors and message texts."""
+
+    def __init__(self, dim, vectors=None, entries=None):
+        self.entries = entries or []
+        count = len(self.entries)
+        self.vectors = np.zeros((max(count, 16), dim), dtype=np.float32)
+        if count:
+            self.vectors[:count] = vectors
+
+    def append(self, vector, entry):
+        count = len(self.entries)
+        if count == len(self.vectors):
+            grown = np.zeros((count * 2, self.vectors.shape[1]), dtype=np.float32)
+            grown[:count] = self.vectors
+            self.vectors = grown
+        self.vectors[count] = vector
+        self.entries.append(entry)
+
+
+class VectorIndex:
+    """Per-user message embeddings persisted as append-only files.
+
+    Each user has `<user_id>.vec` (raw float32 rows) and `<user_id>.jsonl`
+    (message text and author) in `directory`. `add` appends one row to both
+    files, so indexing is incremental; the indexes of the `max_loaded_users`
+    most recently searched users are kept in memory.
+    """
+
+    def __init__(self, directory, embed=None, max_loaded_users=64):
+        self.directory = directory
+        self.embed = embed or HashingEmbedder()
+        self.max_loaded_users = max_loaded_users
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, user_id):
+        base = os.path.join(self.directory, str(user_id))
+        return base + ".vec", base + ".jsonl"
+
+    def _load(self, user_id) -> UserVectors:
+        index = self._loaded.get(user_id)
+        if index is not None:
+            self._loaded.move_to_end(user_id)
+            return index
+
+        vec_path, text_path = self._paths(user_id)
+        dim = self.embed([""]).shape[1]
+        if os.path.exists(vec_path):
+            vectors = np.fromfile(vec_path, dtype=np.float32).reshape(-1, dim)
+            with open(text_path, encoding="utf-8") as f:
+                entries = [json.loads(line) for line in f]
+            count = min(len(vectors), len(entries))
+            index = UserVectors(dim, vectors[:count], entries[:count])
+        else:
+            index = UserVectors(dim)
+
+        self._loaded[user_id] = index
+        if len(self._loaded) > self.max_loaded_users:
+            self._loaded.popitem(last=False)
+        return index
+
+    def add(self, user_id: int, message_text: str, is_bot: bool):
+        vector = self.embed([message_text])[0]
+        entry = {"text": message_text, "is_bot": bool(is_bot)}
+        vec_path, text_path = self._paths(user_id)
+        with self._lock:
+            with open(vec_path, "ab") as f:
+                vector.tofile(f)
+            with open(text_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            index = self._loaded.get(user_id)
+            if index is not None:
+                index.append(vector, entry)
+
+    def search(self, user_id: int, query: str, k=3, skip_recent=0, min_score=0.2) -> list:
+        """Top-k (text, is_bot, score) older than the newest `skip_recent` messages."""
+        with self._lock:
+            index = self._load(user_id)
+            count = len(index.entries) - skip_recent
+            if count <= 0 or k <= 0:
+                return []
+            scores = index.vectors[:count] @ self.embed([query])[0]
+            top = np.argpartition(-scores, k - 1)[:k] if count > k else np.arange(count)
+            top = top[np.argsort(-scores[top])]
+            return [
+                (index.entries[i]["text"], index.entries[i]["is_bot"], float(scores[i]))
+                for i in top
+                if scores[i] >= min_score
+            ]
+
+    def clear(self, user_id: int):
+        with self._lock:
+            self._loaded.pop(user_id, None)
+            for path in self._paths(user_id):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def close(self):
+        with self._lock:
+            self._loaded.clear()
@@ -0,0 +1,86 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Runs callbacks at wall-clock deadlines from a single heap.
+
+    One task sleeps until the earliest deadline and is woken early when a
+    sooner one is added, so idle cost is zero however many timers are
+    pending. Entries may carry a key; scheduling the same key again
+    replaces the old entry, which is dropped lazily when it surfaces.
+    Due callbacks run as their own tasks so a slow one cannot delay the rest.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._keys = {}
+        self._order = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+
+    def schedule(self, when: float, callback, key=None):
+        """Call the coroutine function `callback()` at epoch `when`."""
+        if key is not None:
+            self.cancel(key)
+        entry = [when, next(self._order), callback, key]
+        if key is not None:
+            self._keys[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        entry = self._keys.pop(key, None)
+        if entry is not None:
+            entry[2] = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            while self._heap and self._heap[0][2] is None:
+                heapq.heappop(self._heap)
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            when, _, callback, key = heapq.heappop(self._heap)
+            if key is not None:
+                self._keys.pop(key, None)
+            task = asyncio.create_task(self._fire(callback))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _fire(self, callback):
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"Scheduled callback failed: {e}")
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+
+SETTINGS_FIELDS = ("age", "style", "advice", "bot_gender", "user_gender")
+
+
+class UserSettings:
+    """One user's preferences; `__slots__` keeps each record to a few dozen bytes."""
+
+    __slots__ = SETTINGS_FIELDS
+
+    def __init__(self, age=None, style="short", advice=False, bot_gender=None, user_gender=None):
+        self.age = age
+        self.style = style or "short"
+        self.advice = bool(advice)
+        self.bot_gender = bot_gender
+        self.user_gender = user_gender
+
+
+class SettingsStore:
+    """Bounded LRU of user settings in front of the `users` table.
+
+    Records are loaded on first access and every change is written through,
+    so the cache can drop any entry at any time and only the
+    `max_users` most recently active users are kept in memory.
+    """
+
+    def __init__(self, db, max_users=100_000):
+        self.db = db
+        self.max_users = max_users
+        self._settings = OrderedDict()
+
+    async def get(self, user_id: int) -> UserSettings:
+        settings = self._settings.get(user_id)
+        if settings is not None:
+            self._settings.move_to_end(user_id)
+            return settings
+        row = await self.db.get_user_settings(user_id)
+        settings = UserSettings(*row) if row else UserSettings()
+        self._remember(user_id, settings)
+        return settings
+
+    async def update(self, user_id: int, **changes):
+        settings = await self.get(user_id)
+        for name, value in changes.items():
+            setattr(settings, name, value)
+        await self.db.save_user_settings(user_id, changes)
+
+    def invalidate(self, user_id: int):
+        self._settings.pop(user_id, None)
+
+    def _remember(self, user_id, settings):
+        self._settings[user_id] = settings
+        self._settings.move_to_end(user_id)
+        if len(self._settings) > self.max_users:
+            self._settings.popitem(last=False)
+
+    def __len__(self):
+        return len(self._settings)
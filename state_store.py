@@ -0,0 +1,122 @@
+import json
+import time
+
+import db_connection
+
+MIGRATIONS = [
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_state_expires_at ON state (expires_at) WHERE expires_at IS NOT NULL',
+    ),
+]
+
+
+class MemoryStateStore:
+    """Process-local key/value state with optional per-key TTL.
+
+    Keys without a TTL cost a single dict lookup; expiring keys are also
+    tracked in `_expires` and dropped lazily on read, plus a sweep every
+    `purge_every` writes so abandoned keys do not pile up.
+    """
+
+    def __init__(self, purge_every=1024):
+        self._values = {}
+        self._expires = {}
+        self._purge_every = purge_every
+        self._writes = 0
+
+    async def get(self, key, default=None):
+        value = self._values.get(key, default)
+        if self._expires and key in self._expires and self._expires[key] <= time.time():
+            self._drop(key)
+            return default
+        return value
+
+    async def get_many(self, keys) -> dict:
+        return {key: value for key in keys if (value := await self.get(key)) is not None}
+
+    async def set(self, key, value, ttl=None):
+        self._values[key] = value
+        if ttl is not None:
+            self._expires[key] = time.time() + ttl
+        elif self._expires:
+            self._expires.pop(key, None)
+        self._writes += 1
+        if self._writes % self._purge_every == 0:
+            self.purge()
+
+    async def set_many(self, mapping: dict, ttl=None):
+        for key, value in mapping.items():
+            await self.set(key, value, ttl)
+
+    async def delete(self, key):
+        self._drop(key)
+
+    def purge(self):
+        now = time.time()
+        for key in [key for key, expires_at in self._expires.items() if expires_at <= now]:
+            self._drop(key)
+
+    def _drop(self, key):
+        self._values.pop(key, None)
+        self._expires.pop(key, None)
+
+    async def close(self):
+        pass
+
+
+class SQLiteStateStore:
+    """Key/value state in a SQLite table that several processes can share.
+
+    Values are stored as JSON. Synchronous like the other DB classes; wrap
+    it in `AsyncDB` to use it from handlers.
+    """
+
+    def __init__(self, db_file="state.db"):
+        self.conn = db_connection.acquire(db_file)
+        db_connection.migrate(self.conn, "state", MIGRATIONS)
+
+    def get(self, key, default=None):
+        row = self.conn.fetchone('''
+            SELECT value FROM state
+            WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)
+        ''', (key, time.time()))
+        return json.loads(row[0]) if row else default
+
+    def get_many(self, keys) -> dict:
+        keys = list(keys)
+        if not keys:
+            return {}
+        rows = self.conn.fetchall(f'''
+            SELECT key, value FROM state
+            WHERE key IN ({", ".join("?" * len(keys))}) AND (expires_at IS NULL OR expires_at > ?)
+        ''', (*keys, time.time()))
+        return {key: json.loads(value) for key, value in rows}
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, mapping: dict, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        self.conn.executemany('''
+            INSERT INTO state (key, value, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+        ''', [(key, json.dumps(value, ensure_ascii=False), expires_at) for key, value in mapping.items()])
+
+    def delete(self, key):
+        self.conn.execute('DELETE FROM state WHERE key = ?', (key,))
+
+    def purge(self):
+        """Delete expired keys; reads already ignore them."""
+        return self.conn.execute('DELETE FROM state WHERE expires_at <= ?', (time.time(),))
+
+    def close(self):
+        if self.conn is not None:
+            db_connection.release(self.conn)
+            self.conn = None
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from outbox import TELEGRAM_MESSAGE_LIMIT, split_text
+
+
+class StreamingReply:
+    """Progressively edits one Telegram reply while an LLM response streams in.
+
+    The reply is sent on the first `feed` and then edited at most once per
+    `min_interval` seconds, which keeps a chat well under Telegram's edit
+    rate limit. `render` turns the accumulated raw text into what is shown.
+    """
+
+    def __init__(self, message, render=None, min_interval=1.0, parse_mode="Markdown"):
+        self.message = message
+        self.render = render or (lambda text: text)
+        self.min_interval = min_interval
+        self.parse_mode = parse_mode
+        self.chunks = []
+        self.sent = None
+        self._shown = ""
+        self._next_edit_at = 0.0
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    async def feed(self, chunk: str):
+        self.chunks.append(chunk)
+        if time.monotonic() >= self._next_edit_at:
+            await self._show(self.render(self.text))
+
+    async def finish(self, text: str):
+        """Show the final text, waiting out the throttle if needed.
+
+        Text beyond one Telegram message continues in follow-up messages.
+        """
+        delay = self._next_edit_at - time.monotonic()
+        if self.sent is not None and delay > 0:
+            await asyncio.sleep(delay)
+        first, *rest = split_text(text)
+        await self._show(first)
+        for chunk in rest:
+            await self.message.answer(chunk, parse_mode=self.parse_mode)
+
+    async def _show(self, text: str):
+        text = text[:TELEGRAM_MESSAGE_LIMIT]
+        if not text.strip() or text == self._shown:
+            return
+        try:
+            if self.sent is None:
+                self.sent = await self.message.reply(text, parse_mode=self.parse_mode)
+            else:
+                await self.sent.edit_text(text, parse_mode=self.parse_mode)
+        except TelegramRetryAfter as e:
+            self._next_edit_at = time.monotonic() + e.retry_after
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+        self._shown = text
+        self._next_edit_at = time.monotonic() + self.min_interval
@@ -0,0 +1,50 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+PREMIUM = math.inf
+NO_ACCESS = 0
+
+
+class SubscriptionCache:
+    """Bounded LRU of user_id -> entitlement expiry as a Unix epoch.
+
+    Premium users never expire (`PREMIUM`), trial users expire at
+    trial start + 3 days, everyone else is cached as `NO_ACCESS`. A trial
+    entry evicts itself once its expiry passes, so the next check re-reads
+    the database instead of trusting stale state.
+    """
+
+    def __init__(self, max_users=100_000):
+        self.max_users = max_users
+        self._expiry = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, user_id: int, now=None):
+        """Return True/False for cached users, None on a miss."""
+        with self._lock:
+            expires_at = self._expiry.get(user_id)
+            if expires_at is None:
+                return None
+            if now is None:
+                now = time.time()
+            if expires_at != NO_ACCESS and now >= expires_at:
+                del self._expiry[user_id]
+                return None
+            self._expiry.move_to_end(user_id)
+            return now < expires_at
+
+    def set(self, user_id: int, expires_at):
+        with self._lock:
+            self._expiry[user_id] = expires_at
+            self._expiry.move_to_end(user_id)
+            if len(self._expiry) > self.max_users:
+                self._expiry.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._expiry.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._expiry)
@@ -1,211 +1,274 @@
-import sqlite3
+import db_connection
 from datetime import datetime, timedelta
 import math
+import os
 import pytz
+import time
 import uuid
+from database import create_users_table
+from subscription_cache import NO_ACCESS, PREMIUM, SubscriptionCache
+
+TRIAL_DURATION = timedelta(days=3)
+
+
+def import_legacy_db(conn):
+    """Copy subscriptions and keys from a separate users.db attached as `legacy`."""
+    attached = [row[1] for row in conn.execute('PRAGMA database_list')]
+    if "legacy" not in attached:
+        return
+    conn.execute('INSERT OR IGNORE INTO users (user_id) SELECT user_id FROM legacy.subscriptions')
+    conn.execute('''
+        INSERT OR IGNORE INTO subscriptions (user_id, is_premium, trial_activated, trial_start_date, activation_key)
+        SELECT user_id, is_premium, trial_activated, trial_start_date, activation_key FROM legacy.subscriptions
+    ''')
+    conn.execute('''
+        INSERT OR IGNORE INTO activation_keys (key, is_used, used_by_user_id, created_at, used_at)
+        SELECT key, is_used, used_by_user_id, created_at, used_at FROM legacy.activation_keys
+    ''')
+
+
+def backfill_trial_expiry(conn):
+    rows = conn.execute('''
+        SELECT user_id, trial_start_date FROM subscriptions
+        WHERE trial_activated AND trial_start_date IS NOT NULL
+    ''').fetchall()
+    conn.executemany('UPDATE subscriptions SET expires_at = ? WHERE user_id = ?', [
+        (int((datetime.fromisoformat(start) + TRIAL_DURATION).timestamp()), user_id)
+        for user_id, start in rows
+    ])
+
+
+MIGRATIONS = [
+    (import_legacy_db,),
+    (
+        'ALTER TABLE activation_keys ADD COLUMN batch TEXT',
+        'ALTER TABLE activation_keys ADD COLUMN expires_at INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_activation_keys_batch ON activation_keys (batch)',
+    ),
+    (
+        # expires_at: the trial's end as a Unix epoch; trial_notice: the last
+        # trial notice sent (1 ending soon, 2 ended).
+        'ALTER TABLE subscriptions ADD COLUMN expires_at INTEGER',
+        'ALTER TABLE subscriptions ADD COLUMN trial_notice INTEGER DEFAULT 0',
+        backfill_trial_expiry,
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_at ON subscriptions (expires_at)',
+    ),
+]
 
 class SubscriptionDB:
-    def __init__(self, db_file="users.db"):
+    """Subscriptions and activation keys, stored next to the `users` table.
+
+    Sharing the chat database file makes the subscriptions -> users foreign
+    key enforceable and lets a key redemption and the premium grant commit
+    in one transaction. Data from an older separate `legacy_db_file` is
+    imported once.
+    """
+
+    def __init__(self, db_file="chat_history.db", cache=None, legacy_db_file="users.db"):
         self.db_file = db_file
-        self.init_db()
-
-    def init_db(self):
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                user_id INTEGER PRIMARY KEY,
-                is_premium BOOLEAN DEFAULT FALSE,
-                trial_activated BOOLEAN DEFAULT FALSE,
-                trial_start_date TEXT,
-                activation_key TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS activation_keys (
-                key TEXT PRIMARY KEY,
-                is_used BOOLEAN DEFAULT FALSE,
-                used_by_user_id INTEGER,
-                created_at TEXT,
-                used_at TEXT
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        self.cache = cache if cache is not None else SubscriptionCache()
+        self.conn = db_connection.acquire(db_file)
+        self.init_db(legacy_db_file)
+
+    def init_db(self, legacy_db_file=None):
+        with self.conn.transaction() as conn:
+            c = conn.cursor()
+            create_users_table(c)
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS subscriptions (
+                    user_id INTEGER PRIMARY KEY,
+                    is_premium BOOLEAN DEFAULT FALSE,
+                    trial_activated BOOLEAN DEFAULT FALSE,
+                    trial_start_date TEXT,
+                    activation_key TEXT,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS activation_keys (
+                    key TEXT PRIMARY KEY,
+                    is_used BOOLEAN DEFAULT FALSE,
+                    used_by_user_id INTEGER,
+                    created_at TEXT,
+                    used_at TEXT
+                )
+            ''')
+
+        legacy = (
+            legacy_db_file
+            and os.path.exists(legacy_db_file)
+            and os.path.abspath(legacy_db_file) != os.path.abspath(self.db_file)
+        )
+        # ATTACH is not allowed inside a transaction, so it wraps the migration.
+        with self.conn.lock:
+            if legacy:
+                self.conn.conn.execute('ATTACH DATABASE ? AS legacy', (legacy_db_file,))
+            try:
+                db_connection.migrate(self.conn, "subscriptions", MIGRATIONS)
+            finally:
+                if legacy:
+                    self.conn.conn.execute('DETACH DATABASE legacy')
 
     def add_user(self, user_id: int):
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute('''
-            INSERT OR IGNORE INTO subscriptions (user_id)
-            VALUES (?)
-        ''', (user_id,))
-        
-        conn.commit()
-        conn.close()
-
-    def activate_trial(self, user_id: int) -> bool:
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute('SELECT trial_activated FROM subscriptions WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        
-        if result and result[0]:
-            conn.close()
-            return False
-        
+        with self.conn.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+            conn.execute('''
+                INSERT OR IGNORE INTO subscriptions (user_id)
+                VALUES (?)
+            ''', (user_id,))
+
+    def activate_trial(self, user_id: int):
+        """Start the user's trial; returns its end as a Unix epoch, or None if it was used already."""
         moscow_tz = pytz.timezone('Europe/Moscow')
-        trial_start_moscow = datetime.now(moscow_tz).isoformat()
-        
-        c.execute('''
-            UPDATE subscriptions 
-            SET trial_activated = TRUE,
-                trial_start_date = ?
-            WHERE user_id = ?
-        ''', (trial_start_moscow, user_id))
-        
-        conn.commit()
-        conn.close()
-        return True
+        trial_start = datetime.now(moscow_tz)
+        expires_at = int((trial_start + TRIAL_DURATION).timestamp())
+
+        # The upsert's WHERE makes the "not activated yet" check and the
+        # activation a single statement.
+        with self.conn.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+            activated = conn.execute('''
+                INSERT INTO subscriptions (user_id, trial_activated, trial_start_date, expires_at)
+                VALUES (?, TRUE, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    trial_activated = TRUE,
+                    trial_start_date = excluded.trial_start_date,
+                    expires_at = excluded.expires_at,
+                    trial_notice = 0
+                WHERE NOT trial_activated
+            ''', (user_id, trial_start.isoformat(), expires_at)).rowcount > 0
+
+        # Premium users keep their PREMIUM entry; everyone else switches to the trial.
+        if activated and self.cache.check(user_id) is not True:
+            self.cache.set(user_id, expires_at)
+        return expires_at if activated else None
 
     def create_activation_key(self) -> str:
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        new_key = str(uuid.uuid4())
+        return self.create_activation_keys(1)[0]
+
+    def create_activation_keys(self, count: int, batch=None, expires_at=None) -> list:
+        """Issue `count` keys in one transaction; `expires_at` is a Unix epoch."""
+        new_keys = [str(uuid.uuid4()) for _ in range(count)]
         moscow_tz = pytz.timezone('Europe/Moscow')
         created_at_moscow = datetime.now(moscow_tz).isoformat()
-        
-        c.execute('''
-            INSERT INTO activation_keys (key, created_at)
-            VALUES (?, ?)
-        ''', (new_key, created_at_moscow))
-        
-        conn.commit()
-        conn.close()
-        return new_key
+
+        self.conn.executemany('''
+            INSERT INTO activation_keys (key, created_at, batch, expires_at)
+            VALUES (?, ?, ?, ?)
+        ''', [(key, created_at_moscow, batch, expires_at) for key in new_keys])
+
+        return new_keys
+
+    def revoke_batch(self, batch: str) -> int:
+        """Delete the batch's unused keys; redeemed ones stay for the record."""
+        return self.conn.execute('DELETE FROM activation_keys WHERE batch = ? AND NOT is_used', (batch,))
 
     def delete_activation_key(self, key: str) -> bool:
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute('DELETE FROM activation_keys WHERE key = ?', (key,))
-        rows_affected = c.rowcount
-        
-        conn.commit()
-        conn.close()
+        rows_affected = self.conn.execute('DELETE FROM activation_keys WHERE key = ?', (key,))
         return rows_affected > 0
 
-    def use_activation_key(self, key: str, user_id: int) -> bool:
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute('SELECT is_used FROM activation_keys WHERE key = ?', (key,))
-        result = c.fetchone()
-        
-        if result and not result[0]: 
-            moscow_tz = pytz.timezone('Europe/Moscow')
-            used_at_moscow = datetime.now(moscow_tz).isoformat()
-            c.execute('''
-                UPDATE activation_keys 
-                SET is_used = TRUE,
-                    used_by_user_id = ?,
-                    used_at = ?
-                WHERE key = ?
-            ''', (user_id, used_at_moscow, key))
-            
-            conn.commit()
-            conn.close()
-            return True
-        
-        conn.close()
-        return False
+    def redeem_activation_key(self, conn, key: str, user_id: int) -> bool:
+        """Mark the key used within the caller's transaction.
+
+        Returns False if the key is missing, expired or already used. The
+        check and the write are one conditional UPDATE, so of two
+        concurrent redemptions exactly one sees rowcount 1.
+        """
+        moscow_tz = pytz.timezone('Europe/Moscow')
+        used_at_moscow = datetime.now(moscow_tz).isoformat()
+        return conn.execute('''
+            UPDATE activation_keys
+            SET is_used = TRUE,
+                used_by_user_id = ?,
+                used_at = ?
+            WHERE key = ? AND NOT is_used AND (expires_at IS NULL OR expires_at > ?)
+        ''', (user_id, used_at_moscow, key, int(time.time()))).rowcount == 1
 
     def activate_premium(self, user_id: int, activation_key: str) -> bool:
-        if self.use_activation_key(activation_key, user_id):
-            conn = sqlite3.connect(self.db_file)
-            c = conn.cursor()
-            
-            c.execute('''
-                UPDATE subscriptions 
-                SET is_premium = TRUE,
-                    activation_key = ?
-                WHERE user_id = ?
-            ''', (activation_key, user_id))
-            
-            conn.commit()
-            conn.close()
-            return True
-        return False
+        with self.conn.transaction() as conn:
+            if not self.redeem_activation_key(conn, activation_key, user_id):
+                return False
+            conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+            conn.execute('''
+                INSERT INTO subscriptions (user_id, is_premium, activation_key)
+                VALUES (?, TRUE, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    is_premium = TRUE,
+                    activation_key = excluded.activation_key
+            ''', (user_id, activation_key))
+        self.cache.set(user_id, PREMIUM)
+        return True
 
     def check_subscription(self, user_id: int) -> bool:
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute('''
-            SELECT is_premium, trial_activated, trial_start_date
+        allowed = self.cache.check(user_id)
+        if allowed is None:
+            expires_at = self.load_expiry(user_id)
+            self.cache.set(user_id, expires_at)
+            allowed = time.time() < expires_at
+        return allowed
+
+    def load_expiry(self, user_id: int):
+        """Read the user's entitlement expiry epoch from the database."""
+        result = self.conn.fetchone('''
+            SELECT is_premium, trial_activated, expires_at
             FROM subscriptions
             WHERE user_id = ?
         ''', (user_id,))
-        
-        result = c.fetchone()
-        conn.close()
-        
+
         if not result:
-            return False
-            
-        is_premium, trial_activated, trial_start_date_str = result
-        
+            return NO_ACCESS
+
+        is_premium, trial_activated, expires_at = result
+
         if is_premium:
-            return True
-            
-        if trial_activated and trial_start_date_str:
-            moscow_tz = pytz.timezone('Europe/Moscow')
-            trial_start = datetime.fromisoformat(trial_start_date_str)
-            trial_end = trial_start + timedelta(days=3)
-            return datetime.now(moscow_tz) < trial_end
-            
-        return False
+            return PREMIUM
+
+        # An ended trial is cached as a denial like any other, not re-read on every message.
+        if trial_activated and expires_at is not None and expires_at > time.time():
+            return expires_at
+
+        return NO_ACCESS
 
     def get_trial_days_left(self, user_id: int) -> int:
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        
-        c.execute('''
-            SELECT trial_start_date
+        result = self.conn.fetchone('''
+            SELECT expires_at
             FROM subscriptions
             WHERE user_id = ? AND trial_activated = TRUE
         ''', (user_id,))
-        
-        result = c.fetchone()
-        conn.close()
-        
-        if not result or not result[0]:
-            return 0
-            
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        trial_start = datetime.fromisoformat(result[0])
-        trial_end = trial_start + timedelta(days=3)
-        
-        remaining_time = trial_end - datetime.now(moscow_tz)
 
-        remaining_seconds = remaining_time.total_seconds() + 1
+        if not result or result[0] is None:
+            return 0
 
-        print(f"[DEBUG] trial_start: {trial_start}")
-        print(f"[DEBUG] trial_end: {trial_end}")
-        print(f"[DEBUG] datetime.now(moscow_tz): {datetime.now(moscow_tz)}")
-        print(f"[DEBUG] remaining_time.total_seconds() (before buffer): {remaining_time.total_seconds()}")
-        print(f"[DEBUG] remaining_seconds (after buffer): {remaining_seconds}")
+        remaining_seconds = result[0] - time.time() + 1
 
         if remaining_seconds <= 0:
             return 0
-        
-        days_left = math.ceil(remaining_seconds / (24 * 3600))
-        
-        return days_left
\ No newline at end of file
+
+        return math.ceil(remaining_seconds / (24 * 3600))
+
+    def get_trial_notices(self, since: int) -> list:
+        """(user_id, expires_at, trial_notice) of trials ending from `since` on with notices pending.
+
+        A range scan on idx_subscriptions_expires_at, so the cost follows the
+        number of recent trials rather than the size of the table.
+        """
+        return self.conn.fetchall('''
+            SELECT user_id, expires_at, trial_notice
+            FROM subscriptions
+            WHERE expires_at >= ? AND trial_notice < 2 AND NOT is_premium
+            ORDER BY expires_at
+        ''', (since,))
+
+    def claim_trial_notice(self, user_id: int, expires_at: int, notice: int) -> bool:
+        """Record `notice` as sent; False if it already was or no longer applies."""
+        return self.conn.execute('''
+            UPDATE subscriptions SET trial_notice = ?
+            WHERE user_id = ? AND expires_at = ? AND trial_notice < ? AND NOT is_premium
+        ''', (notice, user_id, expires_at, notice)) == 1
+
+    def close(self):
+        if self.conn is not None:
+            db_connection.release(self.conn)
+            self.conn = None
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_INSTRUCTION = (
+    "Ты ведёшь заметки психолога. Обнови краткое содержание разговора с "
+    "пользователем: ключевые темы, чувства, важные факты о нём и о чём "
+    "договорились. Пиши от третьего лица, не больше 150 слов."
+)
+
+
+class Summarizer:
+    """Background condensation of old turns into a per-user summary.
+
+    `note_messages` counts stored messages per user; every `every` messages
+    the user is queued. A single worker then folds the turns older than the
+    newest `keep_recent` into the stored summary, using the scheduler's
+    background lane so it never delays interactive replies.
+
+    With a `builder`, only the recent turns it would put in a prompt stay
+    out of the summary: those that fit its token budget less
+    `reserve_tokens` for the incoming message. Turns the budget cuts off
+    are summarized even when they are within the newest `keep_recent`.
+
+    Counts are kept for the `max_users` most recently active users; an
+    evicted user just starts counting again.
+    """
+
+    def __init__(self, db, router, scheduler, every=20, keep_recent=20, max_queued=1000,
+                 builder=None, reserve_tokens=256, max_users=100_000):
+        self.db = db
+        self.router = router
+        self.scheduler = scheduler
+        self.every = every
+        self.keep_recent = keep_recent
+        self.builder = builder
+        self.reserve_tokens = reserve_tokens
+        self.max_users = max_users
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self._counts = OrderedDict()
+        self._queued = set()
+        self._task = None
+
+    def note_messages(self, user_id: int, count: int = 1):
+        self._counts[user_id] = self._counts.get(user_id, 0) + count
+        self._counts.move_to_end(user_id)
+        if len(self._counts) > self.max_users:
+            self._counts.popitem(last=False)
+        if self._counts.get(user_id, 0) < self.every or user_id in self._queued:
+            return
+        try:
+            self.queue.put_nowait(user_id)
+        except asyncio.QueueFull:
+            return
+        self._queued.add(user_id)
+        del self._counts[user_id]
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            user_id = await self.queue.get()
+            try:
+                await self.summarize(user_id)
+            except Exception as e:
+                logger.warning(f"Summary for {user_id} failed: {e}")
+            finally:
+                self._queued.discard(user_id)
+
+    async def _kept(self, user_id: int) -> int:
+        """How many of the newest messages a prompt would show as they are."""
+        if self.builder is None:
+            return self.keep_recent
+        history = await self.db.get_chat_history(user_id, limit=self.keep_recent)
+        budget = self.builder.history_tokens - self.reserve_tokens
+        return len(self.builder.recent_turns(history, budget))
+
+    async def summarize(self, user_id: int):
+        previous = await self.db.get_summary(user_id)
+        summary, after_id = previous if previous else ("", 0)
+        rows = await self.db.get_messages_to_summarize(user_id, after_id, await self._kept(user_id))
+        if not rows:
+            return
+
+        dialogue = "\n".join(
+            f"{'Ассистент' if is_bot else 'Пользователь'}: {text}" for _, text, is_bot in rows
+        )
+        request = (
+            (f"Текущее краткое содержание:\n{summary}\n\n" if summary else "")
+            + f"Новые сообщения:\n{dialogue}"
+        )
+        payloads = {
+            "completion": {
+                "prompt": f"{SUMMARY_INSTRUCTION}\n\n{request}\n\nКраткое содержание:",
+                "temperature": 0.3,
+                "max_tokens": 300
+            },
+            "chat": {
+                "messages": [
+                    {"role": "system", "content": SUMMARY_INSTRUCTION},
+                    {"role": "user", "content": request}
+                ],
+                "temperature": 0.3,
+                "max_tokens": 300
+            }
+        }
+        new_summary = await self.scheduler.run_background(lambda: self.router.complete(payloads))
+        await self.db.save_summary(user_id, new_summary, rows[-1][0])
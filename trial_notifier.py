@@ -0,0 +1,75 @@
+import functools
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+TRIAL_ENDING = 1
+TRIAL_ENDED = 2
+
+
+class TrialNotifier:
+    """Tells trial users when their trial is about to end and when it has.
+
+    At startup it loads the not yet notified trials from an index range scan
+    on `subscriptions.expires_at` and puts two timers per user on the
+    scheduler; new trials are added with `track`. Each notice is claimed
+    with a conditional UPDATE before it is sent, so users who went premium
+    are skipped and several processes never send the same notice twice.
+    When a trial ends the user's subscription cache entry is dropped.
+    """
+
+    def __init__(self, sub_db, cache, scheduler, send, remind_before=86400, catch_up=86400):
+        self.sub_db = sub_db
+        self.cache = cache
+        self.scheduler = scheduler
+        self.send = send
+        self.remind_before = remind_before
+        self.catch_up = catch_up
+
+    async def start(self):
+        """Schedule every trial that ended less than `catch_up` seconds ago or is still running."""
+        rows = await self.sub_db.get_trial_notices(int(time.time()) - self.catch_up)
+        for user_id, expires_at, notice in rows:
+            self.track(user_id, expires_at, notice)
+        logger.info(f"Scheduled trial notices for {len(rows)} users")
+
+    def track(self, user_id: int, expires_at: int, notice: int = 0):
+        if notice < TRIAL_ENDING and self.remind_before > 0:
+            self.scheduler.schedule(
+                expires_at - self.remind_before,
+                functools.partial(self._fire, user_id, expires_at, TRIAL_ENDING),
+                key=(user_id, TRIAL_ENDING)
+            )
+        if notice < TRIAL_ENDED:
+            self.scheduler.schedule(
+                expires_at,
+                functools.partial(self._fire, user_id, expires_at, TRIAL_ENDED),
+                key=(user_id, TRIAL_ENDED)
+            )
+
+    async def _fire(self, user_id, expires_at, notice):
+        now = time.time()
+        if notice == TRIAL_ENDING and now >= expires_at:
+            return
+        if notice == TRIAL_ENDED:
+            self.cache.invalidate(user_id)
+        if not await self.sub_db.claim_trial_notice(user_id, expires_at, notice):
+            return
+
+        if notice == TRIAL_ENDING:
+            hours = math.ceil((expires_at - now) / 3600)
+            text = (
+                f"⏳ Ваш бесплатный период закончится через {hours} ч.\n\n"
+                "🔑 Чтобы продолжить общение, активируйте премиум-подписку с помощью ключа."
+            )
+        else:
+            text = (
+                "⌛ Бесплатный период закончился.\n\n"
+                "🔑 Чтобы продолжить общение, активируйте премиум-подписку: `/activate ВАШ_КЛЮЧ`"
+            )
+        try:
+            await self.send(user_id, text)
+        except Exception as e:
+            logger.warning(f"Could not send trial notice to {user_id}: {e}")
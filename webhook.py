@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import zlib
+
+import aiohttp
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger("webhook")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class HashRing:
+    """Consistent hash of user ids onto worker indexes.
+
+    Each worker owns `replicas` points on a crc32 ring, so a user always
+    lands on the same worker and changing the worker count only moves
+    about 1/N of the users.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        points = sorted(
+            (zlib.crc32(f"{node}:{replica}".encode()), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key):
+        index = bisect.bisect(self._hashes, zlib.crc32(str(key).encode()))
+        return self._nodes[index % len(self._nodes)]
+
+
+def update_user_id(update: dict):
+    """The user an update belongs to; falls back to the chat, then update_id."""
+    for value in update.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user") or value.get("chat")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return update.get("update_id", 0)
+
+
+class WebhookFront:
+    """Accepts Telegram's webhook POSTs and forwards each update to its worker.
+
+    A worker that is down yields 503 instead of rerouting the user, so
+    Telegram retries the update and the user's caches and ordering stay on
+    one process.
+    """
+
+    def __init__(self, worker_urls):
+        self.worker_urls = worker_urls
+        self.ring = HashRing(range(len(worker_urls)))
+        self.session = None
+
+    async def start(self, app=None):
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=60),
+            connector=aiohttp.TCPConnector(limit=0)
+        )
+
+    async def close(self, app=None):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        url = self.worker_urls[self.ring.node(update_user_id(update))]
+        headers = {"Content-Type": "application/json"}
+        if SECRET_HEADER in request.headers:
+            headers[SECRET_HEADER] = request.headers[SECRET_HEADER]
+        try:
+            async with self.session.post(url, data=body, headers=headers) as response:
+                return web.Response(status=response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Worker {url} unavailable: {e}")
+            return web.Response(status=503)
+
+
+class WorkerPool:
+    """Runs `python -m webhook --port N` children and restarts any that exit."""
+
+    def __init__(self, host, ports):
+        self.host = host
+        self.ports = ports
+        self.processes = {}
+        self._task = None
+
+    def _spawn(self, port):
+        env = dict(os.environ)
+        here = os.path.dirname(os.path.abspath(__file__))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [here, env.get("PYTHONPATH")]))
+        # Workers serve /metrics on their own port rather than all binding METRICS_PORT.
+        env["METRICS_PORT"] = "0"
+        self.processes[port] = subprocess.Popen(
+            [sys.executable, "-m", "webhook", "--host", self.host, "--port", str(port)],
+            env=env
+        )
+
+    async def start(self, app=None):
+        for port in self.ports:
+            self._spawn(port)
+        self._task = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for port, process in list(self.processes.items()):
+                if process.poll() is not None:
+                    logger.warning(f"Webhook worker on port {port} exited with {process.returncode}, restarting")
+                    self._spawn(port)
+
+    async def close(self, app=None):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            try:
+                await asyncio.to_thread(process.wait, 10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def run_app(app, host, port):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    stop = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:
+        pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def serve(dp, bot, url, path, host, port, workers=1, secret=None):
+    """Register the webhook with Telegram and serve updates on host:port.
+
+    With one worker the dispatcher runs in this process. Otherwise this
+    process only routes: `workers` children listen on the following ports
+    of 127.0.0.1, each running its own dispatcher, and updates are spread
+    over them by a consistent hash of the user id.
+    """
+    app = web.Application()
+    if workers <= 1:
+        SimpleRequestHandler(dp, bot, secret_token=secret).register(app, path=path)
+        setup_application(app, dp, bot=bot)
+    else:
+        ports = [port + 1 + index for index in range(workers)]
+        pool = WorkerPool("127.0.0.1", ports)
+        front = WebhookFront([f"http://127.0.0.1:{worker_port}{path}" for worker_port in ports])
+        app.router.add_post(path, front.handle)
+        app.on_startup.extend([pool.start, front.start])
+        app.on_cleanup.extend([front.close, pool.close])
+
+    await bot.set_webhook(
+        f"{url}{path}",
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info(f"Serving webhook {path} on {host}:{port} with {workers} worker(s)")
+    try:
+        await run_app(app, host, port)
+    finally:
+        if workers > 1:
+            await bot.session.close()
+
+
+async def run_worker(host, port):
+    import gbot
+
+    app = web.Application()
+    SimpleRequestHandler(gbot.dp, gbot.bot, secret_token=gbot.WEBHOOK_SECRET).register(app, path=gbot.WEBHOOK_PATH)
+    setup_application(app, gbot.dp, bot=gbot.bot)
+    app.router.add_get("/metrics", gbot.metrics.handle)
+    await run_app(app, host, port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run one webhook worker process.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_worker(args.host, args.port))
+    except KeyboardInterrupt:
+        pass